@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks of the event pipeline, the game device state machines and the
+hardware controllers (on stubbed hardware modules, see tests/stubs.py).
+
+Usage (from the controller directory):
+
+    python3 -m benchmarks.bench [-o RESULTS.json] [--compare OLD.json]
+                                [--time SECONDS] [NAME ...]
+
+Per benchmark the best of 5 runs is reported:
+    opsPerSecond, nsPerOp
+    peakBytesPerOp: peak of the memory allocated during a call (tracemalloc),
+                    per op: the temporary objects created per op
+    retainedBlocksPerOp: memory blocks (allocations) still alive after the
+                         runs, per op: non-zero means the op keeps objects,
+                         e.g. a growing queue
+
+The results are written as JSON, so the runs of different commits can be
+compared with --compare.
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import runpy
+import subprocess
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+from tests import stubs
+
+GPIO = stubs.install()
+
+import pinball.e_observable as e_observable  # noqa: E402
+from pinball.controllers.dummy import DummyController  # noqa: E402
+from pinball.controllers.mcp23017 import Mcp23017  # noqa: E402
+from pinball.controllers.powerdriver16 import PowerDriver16  # noqa: E402
+from pinball.eventqueue import EventQueue  # noqa: E402
+from pinball.gameengine import GameEngine, HardwareEngine  # noqa: E402
+from pinball.gamedevices.flipper import Flipper  # noqa: E402
+from pinball.gamedevices.inlane import Inlane  # noqa: E402
+
+CONTROLLER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Registry of (name, setup) tuples, setup() returns (function, ops per call)
+_benchmarks = []
+
+
+def benchmark(name):
+    def register(setup):
+        _benchmarks.append((name, setup))
+        return setup
+    return register
+
+
+def _callback(cause, state=None):
+    pass
+
+
+@benchmark("inform fan-out x1")
+def informFanOut1():
+    return informFanOut(1)
+
+
+@benchmark("inform fan-out x8")
+def informFanOut8():
+    return informFanOut(8)
+
+
+def informFanOut(observers):
+    """Observable.inform() to n observers, including the dispatch of the
+    events."""
+    queue = EventQueue()
+    e_observable.bindEventQueue(queue)
+    observable = e_observable.Observable()
+    for i in range(observers):
+        observable.observe(object(), _callback)
+
+    def run():
+        for i in range(100):
+            observable.inform(True, 0)
+            queue.drain()
+    return (run, 100)
+
+
+@benchmark("tick drain 100 events")
+def tickDrain():
+    """GameEngine.tick() with 100 queued input events, per event."""
+    controller = DummyController()
+    device = controller.getIn("switch")
+    device.observe(object(), _callback)
+    engine = GameEngine([controller], None)
+
+    def run():
+        state = True
+        for i in range(100):
+            device.inform(state, 0)
+            state = not state
+        engine.tick()
+    return (run, 100)
+
+
+@benchmark("flipper transitions")
+def flipperTransitions():
+    """Flipper.flipperEvent(), per transition: press, EOS, EOS lost, EOS,
+    release."""
+    controller = DummyController()
+    button = controller.getIn("button")
+    eos = controller.getIn("eos")
+    flipper = Flipper(button, eos, controller.getOut("energized"),
+                      controller.getOut("hold"))
+    queue = EventQueue()
+    e_observable.bindEventQueue(queue)
+
+    def run():
+        for i in range(20):
+            flipper.flipperEvent(button, True)
+            flipper.flipperEvent(eos, True)
+            flipper.flipperEvent(eos, False)
+            flipper.flipperEvent(eos, True)
+            flipper.flipperEvent(button, False)
+            queue.clear()
+    return (run, 100)
+
+
+@benchmark("inlane detection")
+def inlaneDetection():
+    """Inlane.inlaneEvent(), per switch event: launch, fail, launch,
+    passed, back."""
+    controller = DummyController()
+    upper = controller.getIn("upper")
+    lower = controller.getIn("lower")
+    inlane = Inlane(upper, lower)
+
+    def run():
+        for i in range(20):
+            inlane.inlaneEvent(lower, True)
+            inlane.inlaneEvent(lower, True)
+            inlane.inlaneEvent(lower, True)
+            inlane.inlaneEvent(upper, True)
+            inlane.inlaneEvent(upper, True)
+            inlane.reset()
+    return (run, 100)
+
+
+@benchmark("mcp23017 parseIn 8 inputs")
+def mcp23017ParseIn8():
+    return mcp23017ParseIn(8)
+
+
+@benchmark("mcp23017 parseIn 16 inputs")
+def mcp23017ParseIn16():
+    return mcp23017ParseIn(16)
+
+
+@benchmark("mcp23017 parseIn 16 debounced")
+def mcp23017ParseIn16Debounced():
+    """Same as mcp23017ParseIn16, with inputs debounced over 2 samples, so
+    the first read of a change is filtered."""
+    return mcp23017ParseIn(16, debounce=2)
+
+
+def mcp23017ParseIn(inputs, debounce=1):
+    """Mcp23017._parseIn() of both banks, per bank read. Half of the reads
+    change one input, the other half read the same state again."""
+    queue = EventQueue()
+    e_observable.bindEventQueue(queue)
+    mcp = Mcp23017(0x20)
+    for i in range(inputs):
+        mcp.getIn("input {}".format(i), i % 8, i // 8, debounce=debounce)
+    mcp.configure()
+
+    states = [0x00, 0x01, 0x01, 0x00]
+
+    def run():
+        for i in range(25):
+            for state in states:
+                mcp._parseIn(Mcp23017.BANKA, state, 0)
+                mcp._parseIn(Mcp23017.BANKB, state, 0)
+        queue.clear()
+    return (run, 200)
+
+
+@benchmark("mcp23017 sync 8 units")
+def mcp23017Sync8():
+    """HardwareEngine.tick() of 8 units (0x20..0x27) on one I2C bus, each
+    with 8 inputs and 8 outputs, per tick: every unit reads its inputs and
+    one unit writes a changed output."""
+    queue = EventQueue()
+    e_observable.bindEventQueue(queue)
+    units = [Mcp23017(address) for address in range(0x20, 0x28)]
+    outputs = []
+    for unit in units:
+        for pin in range(8):
+            unit.getIn("input {}".format(pin), pin, Mcp23017.BANKA)
+            outputs.append(unit.getOut("output {}".format(pin), pin,
+                                       Mcp23017.BANKB))
+    engine = HardwareEngine(units)
+    engine.tick()
+
+    def run():
+        for output in outputs:
+            output.set(not output.isActivated())
+            engine.tick()
+        queue.clear()
+    return (run, len(outputs))
+
+
+@benchmark("powerdriver16 sync")
+def powerdriver16Sync():
+    """PowerDriver16.sync() (foreground writes), per sync: one changed
+    output per sync, encoded and written as a packet."""
+    return powerdriver16SyncBoards(1)
+
+
+@benchmark("powerdriver16 sync 4 boards")
+def powerdriver16Sync4():
+    """Same as powerdriver16 sync, with the outputs spread over 4 boards:
+    the cost per sync should not depend on the number of boards."""
+    return powerdriver16SyncBoards(4)
+
+
+def powerdriver16SyncBoards(boards):
+    logging.getLogger("pinball.controllers.powerdriver16").setLevel(
+        logging.ERROR)
+    queue = EventQueue()
+    e_observable.bindEventQueue(queue)
+    pd = PowerDriver16(os.devnull, background=False, boards=boards)
+    outputs = [pd.getOut("output {}".format(i), i % boards, i // 8, i % 8)
+               for i in range(16)]
+    pd.sync()
+
+    def run():
+        for output in outputs:
+            output.activate()
+            pd.sync()
+            output.deactivate()
+            pd.sync()
+        queue.clear()
+    return (run, 32)
+
+
+@benchmark("full tick pinball.py")
+def fullTick():
+    """GameEngine.tick() of the pinball.py game on the stubbed hardware,
+    with a flipper button press and release every 10 frames."""
+    logging.getLogger("pinball").setLevel(logging.ERROR)
+    with mock.patch("os.path.exists", return_value=True):
+        game = runpy.run_path(os.path.join(CONTROLLER, "pinball.py"),
+                              run_name="benchmark")
+    engine = GameEngine(game["controllers"], game["game"])
+    button = game["flipper_L_BUTTON"]._pin
+
+    def run():
+        game  # Keeps the game devices alive
+        for i in range(10):
+            GPIO.levels[button] = 1
+            engine.tick()
+            for j in range(4):
+                engine.tick()
+            GPIO.levels[button] = 0
+            for j in range(5):
+                engine.tick()
+    return (run, 100)
+
+
+def measure(function, ops, minTime):
+    """Returns the results of a benchmark, see the module documentation."""
+    # Calibrate the number of calls per run
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(calls):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= minTime / 10:
+            break
+        calls *= 2
+    calls = max(1, int(calls * minTime / elapsed))
+
+    best = None
+    for run in range(5):
+        gc.collect()
+        start = time.perf_counter_ns()
+        for i in range(calls):
+            function()
+        elapsed = time.perf_counter_ns() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    nsPerOp = best / (calls * ops)
+
+    # Memory, in a separate run: tracing slows down the benchmark
+    gc.collect()
+    gc.disable()
+    tracemalloc.start()
+    function()  # Warm up caches of the traced run
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    function()
+    peak = tracemalloc.get_traced_memory()[1] - current
+    before = tracemalloc.take_snapshot()
+    for i in range(calls):
+        function()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    gc.enable()
+    retained = sum(stat.count_diff
+                   for stat in after.compare_to(before, "filename"))
+
+    return {
+        "opsPerSecond": 1e9 / nsPerOp,
+        "nsPerOp": nsPerOp,
+        "peakBytesPerOp": max(0, peak) / ops,
+        "retainedBlocksPerOp": max(0, retained) / (calls * ops),
+    }
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=CONTROLLER,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare(results, old):
+    print("\n{:32} {:>12} {:>12} {:>8}".format(
+        "benchmark", "old ns/op", "new ns/op", "change"))
+    for (name, result) in results.items():
+        if name not in old:
+            continue
+        (before, after) = (old[name]["nsPerOp"], result["nsPerOp"])
+        print("{:32} {:12.1f} {:12.1f} {:+7.1f}%".format(
+            name, before, after, (after / before - 1) * 100))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the pinball controller")
+    parser.add_argument("names", nargs="*", help="benchmarks to run")
+    parser.add_argument("-o", "--output", help="JSON results file")
+    parser.add_argument("--compare", help="JSON results file to compare to")
+    parser.add_argument("--time", type=float, default=0.2,
+                        help="approximate time (s) per benchmark run")
+    args = parser.parse_args(argv)
+
+    results = {}
+    print("{:32} {:>12} {:>10} {:>10} {:>8}".format(
+        "benchmark", "ops/s", "ns/op", "peak B/op", "blk/op"))
+    for (name, setup) in _benchmarks:
+        if args.names and name not in args.names:
+            continue
+        (function, ops) = setup()
+        result = measure(function, ops, args.time)
+        results[name] = result
+        print("{:32} {:12.0f} {:10.1f} {:10.1f} {:8.2f}".format(
+            name, result["opsPerSecond"], result["nsPerOp"],
+            result["peakBytesPerOp"], result["retainedBlocksPerOp"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": metadata(), "results": results}, f, indent=2,
+                      sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)["results"])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""
+Decodes the ring file of the flight recorder (see pinball/recorder.py), e.g.
+after a crash or a power loss.
+
+Usage: flightrecorder.py FILE [--trace TRACE] [--last N] [--frames]
+
+Prints the records, oldest first. With --trace, the input changes are
+written as a replay trace instead, which simulate.py can replay:
+
+    flightrecorder.py pinball.rec --trace crash.txt
+    simulate.py crash.txt
+
+The game engine keeps the recording of the previous game process as
+FILE.1, e.g. pinball.rec.1 after a crash and restart.
+"""
+import argparse
+import datetime
+import sys
+
+import pinball.recorder as recorder
+from pinball.controllers.simulation import formatTrace
+
+
+def formatRecords(recording, frames=False):
+    """Returns the lines of the records of a recording."""
+    lines = []
+    for (timestamp, index, kind, state) in recording.records:
+        if kind == recorder.FRAME and not frames:
+            continue
+        wallclock = datetime.datetime.fromtimestamp(
+            (timestamp + recording.wallclock) / 1e9)
+        if kind <= recorder.OUTPUT:
+            what = "{:d} {}".format(state, recording.devices[index][0])
+        elif kind == recorder.TIMER:
+            what = "lateness {}us".format(index)
+        else:
+            what = "#{}".format(index)
+        lines.append("{} {:.6f} {:<6} {}".format(
+            wallclock.strftime("%H:%M:%S.%f"), timestamp / 1e9,
+            recorder.KINDS[kind], what))
+    return lines
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("file", help="flight recorder ring file")
+    parser.add_argument("--trace",
+                        help="write the input changes as a replay trace to "
+                             "this file")
+    parser.add_argument("--last", type=int,
+                        help="only the last N records")
+    parser.add_argument("--frames", action="store_true",
+                        help="include the frame records")
+    args = parser.parse_args(argv)
+
+    recording = recorder.read(args.file)
+    if args.last is not None:
+        recording.records = recording.records[-args.last:]
+
+    if args.trace:
+        lines = ["# Flight recording of process {}, {} records".format(
+            recording.pid, len(recording.records))]
+        lines += formatTrace(recording.toTrace())
+        with open(args.trace, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    else:
+        sys.stdout.write("\n".join(formatRecords(recording, args.frames)) +
+                         "\n")
+
+    sys.stderr.write("{} of {} records, process {}\n".format(
+        len(recording.records), recording.head, recording.pid))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -10,6 +10,11 @@ class MyGame():
     def __init__(self, flipper_l, flipper_r, slingshot_l, slingshort_r,
                  inlane, led_1, led_2, led_3):
 
+        # Keep the game devices alive, observers are referenced weakly
+        self.flippers = [flipper_l, flipper_r]
+        self.slingshots = [slingshot_l, slingshort_r]
+        self.inlane = inlane
+
         self.leds = [led_1, led_2, led_3]
         self.active = led_1
         self.ledon = 0
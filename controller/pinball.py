@@ -27,6 +27,7 @@ Construction of a game application:
 
     A) Run GameEngine
     A1) Point a webbrowser to the debug console (http://hostname:8888)
+    A2) After a crash, decode pinball.rec with flightrecorder.py
     B) 'Enjoy' :)
 
 """
@@ -62,13 +63,13 @@ flipper_R_EOS = raspberry.getIn("R Flipper EOS", -1)
 flipper_L_BUTTON = raspberry.getIn("L Flipper button", 23)
 flipper_R_BUTTON = raspberry.getIn("R Flipper button", 24)
 
-slingshot_left_detect = mcp23017.getIn("L Slingshot detect", 3, 0)
+slingshot_left_detect = mcp23017.getIn("L Slingshot detect", 3, 0, debounce=2)
 slingshot_left_coil = powerdriver16.getOut("L Slingshot kicker", 0, BANKB, 4)
-slingshot_right_detect = mcp23017.getIn("R Slingshot detect", 4, 0)
+slingshot_right_detect = mcp23017.getIn("R Slingshot detect", 4, 0, debounce=2)
 slingshot_right_coil = powerdriver16.getOut("R Slingshot kicker", 0, BANKB, 5)
 
-inlane_detect_upper = mcp23017.getIn("Switch inlane Upper", 6, 0, inv=True)
-inlane_detect_lower = mcp23017.getIn("Switch inlane Lower", 5, 0, inv=True)
+inlane_detect_upper = mcp23017.getIn("Switch inlane Upper", 6, 0, inv=True, stableTime=0.005)
+inlane_detect_lower = mcp23017.getIn("Switch inlane Lower", 5, 0, inv=True, stableTime=0.005)
 
 led_1 = Led(mcp23017.getOut("Led Blue", 0, 1))
 led_2 = Led(mcp23017.getOut("Led Green", 1, 1))
@@ -103,5 +104,5 @@ if __name__ == "__main__":
     logger.addHandler(handler)
     logger.setLevel(logging.DEBUG)
 
-    ge = GameEngine(controllers, game)
+    ge = GameEngine(controllers, game, flightRecorder="pinball.rec")
     ge.run()
@@ -0,0 +1,62 @@
+import time
+
+
+class Clock():
+
+    """
+    Monotonic engine clock, times are in nanoseconds. Game devices must use
+    now() instead of the wall clock (time.time()), so the engine can run on a
+    different clock, e.g. a simulated clock for faster-than-real-time tests.
+    """
+
+    def now(self):
+        return time.monotonic_ns()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+# The engine clock. The game engine binds its own clock on construction, see
+# bindClock().
+_clock = Clock()
+
+
+def bindClock(clock):
+    """Lets now() use the given clock. Returns the previously bound clock."""
+    global _clock
+    old = _clock
+    _clock = clock
+    return old
+
+
+def getClock():
+    return _clock
+
+
+def now():
+    """Returns the current engine time (ns)."""
+    return _clock.now()
+
+
+class VirtualClock(Clock):
+
+    """
+    Simulated engine clock: time only advances by sleep() (or advance()), so
+    the game runs as fast as possible and fully deterministic. Bind it (see
+    bindClock()) before the game devices are created.
+    """
+
+    def __init__(self, start=0):
+        self._now = start
+
+    def now(self):
+        return self._now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self._now += round(seconds * 1e9)
+
+    def advance(self, ns):
+        """Moves the clock ns nanoseconds forward."""
+        if ns > 0:
+            self._now += ns
@@ -0,0 +1,112 @@
+"""
+Input debouncing for the hardware controllers.
+
+A switch that closes or opens bounces: for a few milliseconds its level
+toggles, and every toggle that is sampled would otherwise become an event.
+A debounced input only reports a new level when it has been stable long
+enough, per input given as
+
+    samples     the number of consecutive samples (default 1: no debouncing)
+    stableTime  the minimum time (s) the level is stable (default 0)
+
+A change that returns to the reported level before it was accepted is a
+glitch, it is counted on the input device (see InGameDevice.getGlitchCount())
+and never enters the engine. An accepted change is reported with the moment
+its level was first sampled as timestamp, so the debounce delay counts as
+input latency.
+"""
+
+
+class BankDebouncer():
+
+    """
+    Debounces a bank of inputs, one bit each, with bitmask arithmetic on the
+    whole bank. A bank is an integer of any width, e.g. a register of an I/O
+    extender.
+
+    The sample counts are integrated over a history of raw bank values: the
+    pins that were high in the last n samples are the AND of the last n
+    values, the pins that were low the NOR. The stable time is tracked per
+    pin, but only for the pins that differ from their reported level. A bank
+    that is stable costs a single compare per sample.
+    """
+
+    def __init__(self, state=0):
+        """Constructor, state is the initial (reported) level of the bank."""
+        self.state = state
+        self._raw = state
+        self._pending = 0       # Pins of which the raw level differs
+        self._since = {}        # Per pending pin, when it started to differ
+
+        self._groups = {}       # Per sample count the pins (mask)
+        self._timed = {}        # Per pin (mask) the stable time (ns)
+        self._history = [state]
+
+    def configure(self, pin, samples=1, stableTime=0):
+        """Sets the debounce settings of a pin (mask)."""
+        for (count, mask) in list(self._groups.items()):
+            self._groups[count] = mask & ~pin
+        if samples > 1:
+            self._groups[samples] = self._groups.get(samples, 0) | pin
+        self._groups = {count: mask for (count, mask) in self._groups.items()
+                        if mask}
+        self._timed.pop(pin, None)
+        if stableTime > 0:
+            self._timed[pin] = int(stableTime * 1e9)
+        self._history = [self._raw] * max([1] + list(self._groups))
+
+    def isSettled(self):
+        """Returns True if no change is waiting to be accepted."""
+        return not self._pending
+
+    def update(self, raw, now):
+        """Processes a sample of the bank, taken at now (ns). Returns the
+        (accepted, glitches) masks: the pins of which a new level is accepted
+        (see state), and the pins of which a change was suppressed."""
+        if raw == self._raw and not self._pending:
+            return (0, 0)
+
+        history = self._history
+        if len(history) > 1:
+            history.pop()
+            history.insert(0, raw)
+        self._raw = raw
+
+        pending = raw ^ self.state
+        glitches = self._pending & ~pending
+        started = pending & ~self._pending
+        self._pending = pending
+        if not pending:
+            return (0, glitches)
+
+        if started:
+            since = self._since
+            bit = 1
+            while bit <= started:
+                if started & bit:
+                    since[bit] = now
+                bit <<= 1
+
+        # Pins with a sample count of 1 are stable after one sample
+        accepted = pending
+        for (count, mask) in self._groups.items():
+            high = low = raw
+            for value in history[1:count]:
+                high &= value
+                low |= value
+            accepted &= ~mask | high | ~low
+
+        if self._timed:
+            for (pin, stableTime) in self._timed.items():
+                if accepted & pin and now - self._since[pin] < stableTime:
+                    accepted &= ~pin
+
+        if accepted:
+            self.state ^= accepted
+            self._pending &= ~accepted
+        return (accepted, glitches)
+
+    def since(self, pin):
+        """Returns the moment (ns) the accepted level of the pin (mask) was
+        first sampled."""
+        return self._since[pin]
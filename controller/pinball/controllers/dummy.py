@@ -27,7 +27,10 @@ class DummyController(HWController):
         self._devices.append(outDevice)
         return outDevice
 
-    def sync(self):
+    def commit(self):
+        pass
+
+    def sample(self):
         pass
 
     def activate(self, outDevice):
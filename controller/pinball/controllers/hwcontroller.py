@@ -5,11 +5,26 @@ from pinball.e_observable import Observable
 class HWController(Observable):
     """Class that can be used by subclasses to represent hardware controllers.
     Hardware controllers are able to 'drive' single hardware devices, such as
-    switches, coils, etc."""
+    switches, coils, etc.
+
+    Controllers that share a physical bus must have the same bus identifier.
+    The hardware engine may run the sync phases of controllers on different
+    busses concurrently. The controllers on a bus are synced in busOrder.
+
+    A controller that writes its outputs after commit() returned (e.g. from a
+    background thread) sets tracesCommit, and reports to the latency tracer
+    itself when the outputs are written (see pinball.latency)."""
+
+    bus = None  # Bus identifier, None means a bus of its own
+    busOrder = 0  # Position on the bus, e.g. the address of the chip
+    tracesCommit = False  # Reports the commits to the latency tracer itself
 
     def __init__(self):
         Observable.__init__(self)
 
+    def __str__(self):
+        return type(self).__name__
+
     def getHwDevices(self):
         """Returns a list of all registered hardware devices.
 
@@ -23,8 +38,25 @@ class HWController(Observable):
         1. Output devices will get new instructions.
         2. The state of the input devices is read, and new events are triggered
            if there were changes."""
+        self.commit()
+        self.sample()
+
+    def commit(self):
+        """ Sync phase 1: output devices will get new instructions."""
         raise NotImplementedError
 
+    def sample(self):
+        """ Sync phase 2: the state of the input devices is read, and new
+        events are triggered if there were changes."""
+        raise NotImplementedError
+
+    def getNextInputTime(self):
+        """ Returns the engine time (ns) of the next input change if it is
+        known in advance (simulations), float("inf") if the inputs will not
+        change anymore, or None if the inputs may change at any moment (real
+        hardware). See GameEngine.runFor()."""
+        return None
+
     def activate(self, outDevice):
         """ Callback for OutGameDevice to request the controller to activate the
         hardware state for this device. Setting the real hardware state will be
@@ -36,3 +68,17 @@ class HWController(Observable):
         the hardware state for this device. Setting the real hardware state
         will be delayed until sync() is called."""
         raise NotImplementedError
+
+    def pulse(self, outDevice, ms):
+        """ Callback for OutGameDevice to request the controller to activate
+        the hardware state for this device for ms milliseconds.
+
+        By default the pulse is emulated: the device is activated now, and
+        deactivated by endPulse() (called by the OutGameDevice when the pulse
+        time is over). Controllers that can time pulses in hardware override
+        both methods."""
+        self.activate(outDevice)
+
+    def endPulse(self, outDevice):
+        """ Callback for OutGameDevice when the pulse time is over."""
+        self.deactivate(outDevice)
@@ -1,4 +1,7 @@
-from pinball.e_observable import Observable
+from pinball import latency, recorder
+from pinball.e_observable import Observable, eventTime, getEventQueue
+from pinball.eventqueue import EventQueue
+from pinball.gamedevices.timer import getTimerQueue
 
 
 class GameDevice(Observable):
@@ -17,12 +20,20 @@ class GameDevice(Observable):
     def getName(self):
         return self._name
 
+    def getController(self):
+        """Returns the hardware controller of the device."""
+        return self._device
+
     def __str__(self):
         return "{}:{}".format(type(self).__name__, self._name)
 
 
 class OutGameDevice(GameDevice):
 
+    def __init__(self, name, hwgamedevice):
+        GameDevice.__init__(self, name, hwgamedevice)
+        self._pulseEnd = None
+
     def set(self, activated):
         if activated:
             self.activate()
@@ -30,28 +41,108 @@ class OutGameDevice(GameDevice):
             self.deactivate()
 
     def activate(self):
+        if self._pulseEnd is not None:
+            self._cancelPulse()
         self._device.activate(self)
         if self._activated is not True:
             self._activated = True
+            self._trace()
+            self._record()
             Observable.inform(self, self._activated)
 
     def deactivate(self):
+        if self._pulseEnd is not None:
+            self._cancelPulse()
         self._device.deactivate(self)
         if self._activated is not False:
             self._activated = False
+            self._trace()
+            self._record()
+            Observable.inform(self, self._activated)
+
+    def pulse(self, ms):
+        """Activates the device for ms milliseconds. Controllers that support
+        it time the pulse in hardware (precise, single command), for the other
+        controllers it is emulated with an engine timer. Observers are informed
+        at the start and at the (expected) end of the pulse."""
+        if self._pulseEnd is not None:
+            self._cancelPulse()
+        self._device.pulse(self, ms)
+        self._pulseEnd = getTimerQueue().schedule(ms / 1000, self._endPulse)
+        if self._activated is not True:
+            self._activated = True
+            self._trace()
+            self._record()
             Observable.inform(self, self._activated)
 
+    def _trace(self):
+        """Reports the state change to the latency tracer, if it is caused by
+        an input change (see pinball.latency)."""
+        tracer = latency.getTracer()
+        if tracer.enabled:
+            queue = getEventQueue()
+            if queue.origin is not None:
+                tracer.output(queue.origin, self, queue.timestamp)
+
+    def _record(self):
+        """Records the state change in the flight recorder (see
+        pinball.recorder)."""
+        flightrecorder = recorder.getRecorder()
+        if flightrecorder.enabled:
+            flightrecorder.output(self, self._activated)
+
+    def _cancelPulse(self):
+        getTimerQueue().cancel(self._pulseEnd)
+        self._pulseEnd = None
+
+    def _endPulse(self, lateness):
+        deadline = self._pulseEnd.deadline
+        self._pulseEnd = None
+        self._device.endPulse(self)
+        if self._activated is not False:
+            self._activated = False
+            self._record()
+            Observable.inform(self, self._activated, deadline)
+
 
 class InGameDevice(GameDevice):
 
+    eventPriority = EventQueue.INPUT
+
     def __init__(self, name, hwgamedevice, inv=False):
         GameDevice.__init__(self, name, hwgamedevice)
         self._inv = inv
+        self._rules = ()
+        self._glitches = 0
+
+    def addRule(self, rule):
+        """Registers a hardware rule, see pinball.hwrules."""
+        self._rules += (rule,)
+
+    def removeRule(self, rule):
+        self._rules = tuple(r for r in self._rules if r is not rule)
+
+    def addGlitch(self):
+        """Called by a debouncing controller when it suppressed a change of
+        the input, see pinball.controllers.debounce."""
+        self._glitches += 1
+
+    def getGlitchCount(self):
+        return self._glitches
 
-    def inform(self, state):
+    def inform(self, state, timestamp=None):
+        """Called by the controller with the sampled state of the input, and
+        the moment (engine clock, ns) the state was captured."""
         if self._inv:
             state = not state
 
         if self._activated != state:
             self._activated = state
-            Observable.inform(self, state)
+            if timestamp is None:
+                timestamp = eventTime()
+            flightrecorder = recorder.getRecorder()
+            if flightrecorder.enabled:
+                flightrecorder.input(self, state != self._inv, timestamp)
+            for rule in self._rules:
+                rule.trigger(state, timestamp)
+            Observable.inform(self, state, timestamp, self)
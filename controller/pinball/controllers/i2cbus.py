@@ -0,0 +1,126 @@
+import logging
+import time
+
+import smbus
+
+from pinball import clock
+from pinball.profiler import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class I2CBus():
+
+    """
+    Manages a physical I2C bus, shared by all chips on it (see getBus()): one
+    SMBus handle per bus, and per chip the transaction times and errors.
+
+    The chips on a bus are synced one after another in a fixed order every
+    frame (on their address, see HWController.busOrder). A failing
+    transaction is retried once. When it fails again, the chip is backed off:
+    its transactions are skipped (and return None) for a time that doubles
+    with every consecutive failure, from minBackoff up to maxBackoff seconds.
+    Errors are logged and counted, they never raise out of the game loop.
+    """
+
+    def __init__(self, busnr=1, minBackoff=0.01, maxBackoff=1.0):
+        self.name = "i2c-{}".format(busnr)
+        self._smbus = smbus.SMBus(busnr)
+        self._minBackoff = int(minBackoff * 1e9)
+        self._maxBackoff = int(maxBackoff * 1e9)
+        self._chips = {}  # Per chip its I2CChipStats
+
+    def register(self, chip):
+        """Registers a chip, returns its statistics."""
+        stats = self._chips.get(chip)
+        if stats is None:
+            stats = self._chips[chip] = I2CChipStats()
+        return stats
+
+    def read(self, chip, address, register, length):
+        """Reads length bytes from register onwards, returns None if the
+        transaction failed or the chip is backed off."""
+        return self._transaction(chip, self._smbus.read_i2c_block_data,
+                                 address, register, length)
+
+    def write(self, chip, address, register, data):
+        """Writes the bytes in data from register onwards, returns False if
+        the transaction failed or the chip is backed off."""
+        return self._transaction(chip, self._smbus.write_i2c_block_data,
+                                 address, register, data) is not None
+
+    def _transaction(self, chip, function, address, register, argument):
+        stats = self._chips[chip]
+        if stats.retryAt is not None:
+            if clock.now() < stats.retryAt:
+                stats.skipped += 1
+                return None
+
+        for attempt in (0, 1):
+            start = time.monotonic_ns()
+            try:
+                result = function(address, register, argument)
+            except OSError as e:
+                error = e
+                stats.errors += 1
+                if attempt == 0:
+                    stats.retries += 1
+                continue
+            stats.time.add(time.monotonic_ns() - start)
+            stats.transactions += 1
+            if stats.retryAt is not None:
+                logger.info("{} {} recovered after {} failures".format(
+                    self.name, chip, stats.failures))
+                stats.retryAt = None
+            stats.failures = 0
+            return True if result is None else result
+
+        stats.failures += 1
+        backoff = min(self._maxBackoff,
+                      self._minBackoff << min(stats.failures - 1, 16))
+        stats.retryAt = clock.now() + backoff
+        if stats.failures == 1:
+            logger.warning("{} {} failed ({}), backing off".format(
+                self.name, chip, error))
+        return None
+
+    def getStats(self):
+        """Returns per chip (in bus order) the number of transactions, errors,
+        retries and skipped transactions, whether it is backed off, and its
+        transaction times (ns)."""
+        return {str(chip): stats.summary() for (chip, stats) in
+                sorted(self._chips.items(), key=lambda x: x[0].busOrder)}
+
+
+class I2CChipStats():
+
+    def __init__(self):
+        self.transactions = 0
+        self.errors = 0
+        self.retries = 0
+        self.skipped = 0
+        self.failures = 0     # Consecutive failed transactions
+        self.retryAt = None   # End (ns) of the back off, None if not failing
+        self.time = Histogram()
+
+    def summary(self):
+        return {
+            "transactions": self.transactions,
+            "errors": self.errors,
+            "retries": self.retries,
+            "skipped": self.skipped,
+            "backedOff": self.retryAt is not None,
+            "time": self.time.summary(),
+        }
+
+
+# The managers of the buses in use, per bus number
+_buses = {}
+
+
+def getBus(busnr=1):
+    """Returns the manager of the I2C bus, shared by all its chips."""
+    bus = _buses.get(busnr)
+    if bus is None:
+        bus = _buses[busnr] = I2CBus(busnr)
+    return bus
@@ -1,6 +1,9 @@
 import logging
-import smbus
 
+from pinball import clock
+
+from pinball.controllers import i2cbus
+from pinball.controllers.debounce import BankDebouncer
 from pinball.controllers.hwgamedevice import OutGameDevice, InGameDevice
 from pinball.controllers.hwcontroller import HWController
 
@@ -49,24 +52,73 @@ class Mcp23017(HWController):
      SDA: I2C data
      RESET: always set to high, same voltage as VDD
      A1,A1,A2: GND --> I2C address 0x20. Refer to datasheet for other configuration options.
+     INTA: (optional) interrupt line, connect to a Raspberry Pi GPIO pin
+
+    # Interrupt mode
+    By default the input registers are read every frame. When an interrupt pin
+    is given, the unit is configured to pull INTA low on any input change
+    (INTA and INTB mirrored), and the inputs are only read after the Raspberry
+    Pi detected a falling edge on that pin. The captured state at the moment of
+    the interrupt (INTCAP) is processed first, so short pulses are not missed.
+    As a safety net the inputs are still read every pollInterval seconds.
+
+    # Debouncing
+    Inputs can be debounced per pin, see getIn() and
+    pinball.controllers.debounce. A bank with debounced inputs is filtered as
+    a whole byte by a BankDebouncer. In interrupt mode its inputs are read
+    every frame while a change waits to be accepted, and the captured state
+    is not used (it is likely a bounce).
+
+    # Bus
+    All units on an I2C bus share its bus manager (see
+    pinball.controllers.i2cbus): they are synced in address order, and a
+    unit that fails is backed off without raising. Failed output writes and
+    configuration are retried on the next commit.
     """
 
-    # Device specific registers
+    # Device specific registers (IOCON.BANK = 0, sequential addressing)
     IODIRA = 0x00   # Pin direction (bank A)
     IODIRB = 0x01   # Pin direction (bank B)
+    IPOLA = 0x02    # Input polarity (bank A)
+    IPOLB = 0x03    # Input polarity (bank B)
+    GPINTENA = 0x04  # Interrupt-on-change enable (bank A)
+    GPINTENB = 0x05  # Interrupt-on-change enable (bank B)
+    DEFVALA = 0x06  # Default compare value for interrupts (bank A)
+    DEFVALB = 0x07  # Default compare value for interrupts (bank B)
+    INTCONA = 0x08  # Interrupt compare mode, 0: on change (bank A)
+    INTCONB = 0x09  # Interrupt compare mode, 0: on change (bank B)
+    IOCON = 0x0A    # Configuration register (0x0A and 0x0B are the same)
+    GPPUBA = 0x0C   # Register for pullup config (bank A)
+    GPPUBB = 0x0D   # Register for pullup config (bank B)
+    INTFA = 0x0E    # Interrupt flags (bank A)
+    INTFB = 0x0F    # Interrupt flags (bank B)
+    INTCAPA = 0x10  # Input state captured at interrupt (bank A)
+    INTCAPB = 0x11  # Input state captured at interrupt (bank B)
     GPIOA = 0x12    # Register for inputs (bank A)
     GPIOB = 0x13    # Register for inputs (bank B)
     OLATA = 0x14    # Register for outputs (bank A)
     OLATB = 0x15    # Register for outputs (bank B)
-    GPPUBA = 0x0C   # Register for pullup config (bank A)
-    GPPUBB = 0x0D   # Register for pullup config (bank B)
+
+    IOCON_MIRROR = 0x40  # INTA and INTB are internally connected
 
     BANKA = 0x00    # Index in state variable :for this bank
     BANKB = 0x01
 
-    def __init__(self, address):
+    def __init__(self, address, busnr=1, interruptPin=None,
+                 pollInterval=0.05):
+        """Constructor.
+        @param address I2C address of the unit
+        @param busnr I2C bus number
+        @param interruptPin Raspberry Pi (BCM) pin connected to INTA, None to
+                            read the inputs every frame
+        @param pollInterval Fallback poll interval (s) in interrupt mode
+        """
+        HWController.__init__(self)
 
-        self.bus = smbus.SMBus(1)
+        self._i2c = i2cbus.getBus(busnr)
+        self._i2c.register(self)
+        self.bus = self._i2c.name
+        self.busOrder = address
         self._address = address
 
         # Dirty flag, if True the OUTPUT state of hardware has to be updated
@@ -84,17 +136,50 @@ class Mcp23017(HWController):
         # For bank A and B keep the input devices
         self._indevices = [[], []]
 
+        # For bank A and B the last read register value, the last known input
+        # state, and a table that maps each change bitmask (0..255) to the
+        # (device, pin) tuples of the changed inputs, see _parseIn().
+        self._lastread = [0x00, 0x00]
+        self._instate = [0x00, 0x00]
+        self._changetable = [self._makeChangeTable([]),
+                             self._makeChangeTable([])]
+
+        # For bank A and B the debouncer, None if no input is debounced
+        self._debouncers = [None, None]
+
         # Keep all devices in a single list to return to the HWController
         self._devices = []
 
-        # Initialise by setting all values as output and set to LOW
-        self.bus.write_byte_data(self._address, self.GPPUBA, 0x00)
-        self.bus.write_byte_data(self._address, self.IODIRA, 0x00)
+        self._interruptPin = interruptPin
+        if interruptPin is not None:
+            self._setupInterrupt(interruptPin, pollInterval)
 
-        self.bus.write_byte_data(self._address, self.GPPUBB, 0x00)
-        self.bus.write_byte_data(self._address, self.IODIRB, 0x00)
+        # Initialise by setting all values as output and set to LOW
+        self.configure()
+        self._dirty = [True, True]
         self.sync()
 
+    def _setupInterrupt(self, pin, pollInterval):
+        """Configures the Raspberry Pi pin to detect the interrupt signals of
+        the unit (INTA, active low)."""
+        import RPi.GPIO as GPIO
+
+        self._pollInterval = int(pollInterval * 1e9)
+        self._nextPoll = 0
+        self._interrupted = True  # Read the inputs on the first sync
+
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(pin, GPIO.FALLING, callback=self._interrupt)
+
+    def _interrupt(self, pin):
+        """Called by the GPIO library (in its own thread) on a falling edge of
+        the interrupt line."""
+        self._interrupted = True
+
+    def __str__(self):
+        return "{}:0x{:02X}".format(type(self).__name__, self._address)
+
     def getHwDevices(self):
         return self._devices
 
@@ -111,60 +196,120 @@ class Mcp23017(HWController):
         self._devices.append(device)
         return device
 
-    def getIn(self, name, pin, bank, pullup=True, **kwargs):
+    def getIn(self, name, pin, bank, pullup=True, debounce=1, stableTime=0,
+              **kwargs):
         """Returns an input device object associated with the provided pin and
         bank.
 
-        This method configures the Mcp23017 unit as well.
+        The Mcp23017 unit is configured on the next sync (or by calling
+        configure()), so all devices are configured in a single transfer.
         @param name Name of the device
         @param pin Pin number on the bank (0..7)
         @param bank Bank identifier (use Mcp23017.BANKA or Mcp23017.BANKB)
         @param pullup Configure pin as pullup
+        @param debounce Number of consecutive samples the input must be
+                        stable before a change is reported
+        @param stableTime Minimum time (s) the input must be stable before a
+                          change is reported
         """
 
         # register pin direction in bank bitmap
         self._directions[bank] |= (1 << pin)
         if pullup:
             self._pullup[bank] |= (1 << pin)
-
-        self.bus.write_byte_data(self._address, self.GPPUBA, self._pullup[self.BANKA])
-        self.bus.write_byte_data(self._address, self.GPPUBB, self._pullup[self.BANKB])
-
-        # Update all direction registers on the device
-        self.bus.write_byte_data(self._address, self.IODIRA, self._directions[self.BANKA])
-        self.bus.write_byte_data(self._address, self.IODIRB, self._directions[self.BANKB])
+        self._configured = False
 
         device = Mcp23017InGameDevice(name, self, pin, bank, **kwargs)
         self._indevices[bank].append(device)
         self._devices.append(device)
+        self._changetable[bank] = self._makeChangeTable(self._indevices[bank])
+        if debounce > 1 or stableTime > 0:
+            if self._debouncers[bank] is None:
+                self._debouncers[bank] = BankDebouncer(self._instate[bank])
+            self._debouncers[bank].configure(device.pin, debounce, stableTime)
         return device
 
-    def sync(self):
-        # Set ouptut devices bank A
-        if self._dirty[self.BANKA]:
-            self._dirty[self.BANKA] = False
-            logger.debug("0x{:02X} - set OLATA: 0x{:02X}".format(self._address, self._state[self.BANKA]))
-            self.bus.write_byte_data(self._address, self.OLATA, self._state[self.BANKA])
-
-        # Set ouptut devices bank B
-        if self._dirty[self.BANKB]:
-            self._dirty[self.BANKB] = False
-            logger.debug("0x{:02X} - set OLATB 0x{:02X}".format(self._address, self._state[self.BANKB]))
-            self.bus.write_byte_data(self._address, self.OLATB, self._state[self.BANKB])
-
-        # Load input devices bank A
-        if self._indevices[self.BANKA]:
-            state = self.bus.read_byte_data(self._address, self.GPIOA)
-            if state < 0:
-                state = 0
-            self._parseIn(self._indevices[self.BANKA], state)
-
-        # Load input devices bank B
-        if self._indevices[self.BANKB]:
-            state = self.bus.read_byte_data(self._address, self.GPIOB)
-            if state < 0:
-                state = 0
-            self._parseIn(self._indevices[self.BANKB], state)
+    @staticmethod
+    def _makeChangeTable(devices):
+        """Returns a 256-entry table that maps a bitmask of changed pins to the
+        (device, pin) tuples of the input devices on these pins."""
+        return [tuple((device, device.pin) for device in devices
+                      if device.pin & changed)
+                for changed in range(256)]
+
+    def configure(self):
+        """Writes the configuration registers IODIRA up to GPPUB in a single
+        block transfer: pin directions and pullups, and in interrupt mode an
+        interrupt on change of all input pins."""
+        (dira, dirb) = self._directions
+        if self._interruptPin is not None:
+            (intena, intenb) = self._directions
+            iocon = self.IOCON_MIRROR
+            self._interrupted = True  # Read the initial state
+        else:
+            (intena, intenb) = (0x00, 0x00)
+            iocon = 0x00
+
+        self._configured = self._i2c.write(self, self._address, self.IODIRA, [
+            dira, dirb,             # IODIRA, IODIRB
+            0x00, 0x00,             # IPOLA, IPOLB
+            intena, intenb,         # GPINTENA, GPINTENB
+            0x00, 0x00,             # DEFVALA, DEFVALB
+            0x00, 0x00,             # INTCONA, INTCONB
+            iocon, iocon,           # IOCON (twice)
+            self._pullup[self.BANKA], self._pullup[self.BANKB]])
+
+    def commit(self):
+        if not self._configured:
+            self.configure()
+            if not self._configured:
+                return
+
+        # Set ouptut devices bank A and B
+        if self._dirty[self.BANKA] or self._dirty[self.BANKB]:
+            logger.debug("0x{:02X} - set OLATA/B: 0x{:02X} 0x{:02X}".format(self._address, self._state[self.BANKA], self._state[self.BANKB]))
+            if self._i2c.write(self, self._address, self.OLATA, self._state):
+                self._dirty = [False, False]
+
+    def sample(self):
+        if not (self._indevices[self.BANKA] or self._indevices[self.BANKB]):
+            return
+        if not self._configured:
+            self.configure()
+            if not self._configured:
+                return
+
+        if self._interruptPin is None:
+            registers = self._i2c.read(self, self._address, self.GPIOA, 2)
+            if registers is None:
+                return
+            (statea, stateb) = registers
+            now = clock.now()
+        else:
+            # Interrupt mode: only read after an interrupt or fallback poll
+            now = clock.now()
+            if not self._interrupted and now < self._nextPoll and \
+                    self._isSettled():
+                return
+            self._interrupted = False
+            self._nextPoll = now + self._pollInterval
+
+            # Read INTFA up to GPIOB; process the state captured at the moment
+            # of the interrupt first, for each bank that flagged an interrupt.
+            registers = self._i2c.read(self, self._address, self.INTFA, 6)
+            if registers is None:
+                # Read again on the next sync
+                self._interrupted = True
+                return
+            (intfa, intfb, capa, capb, statea, stateb) = registers
+            if intfa and self._debouncers[self.BANKA] is None:
+                self._parseIn(self.BANKA, capa, now)
+            if intfb and self._debouncers[self.BANKB] is None:
+                self._parseIn(self.BANKB, capb, now)
+
+        # Load input devices bank A and B
+        self._parseIn(self.BANKA, statea, now)
+        self._parseIn(self.BANKB, stateb, now)
 
     def activate(self, device):
         self._state[device.bank] |= device.pin
@@ -174,13 +319,57 @@ class Mcp23017(HWController):
         self._state[device.bank] &= (~device.pin)
         self._dirty[device.bank] = True
 
-    def _parseIn(self, devices, state):
-        for device in devices:
-            devstate = state & device.pin
-            if device.oldstate != devstate:
-                logger.debug("0x{:02X} - {} input changed 0b{:08b} 0b{:08b} 0b{:08b}".format(self._address, device, state, devstate, device.oldstate))
-                device.oldstate = devstate
-                device.inform(devstate)
+    def getBusStats(self):
+        """Returns the transaction statistics of the unit, see
+        I2CBus.getStats()."""
+        return self._i2c.getStats()[str(self)]
+
+    def _isSettled(self):
+        """Returns True if no debounced change waits to be accepted."""
+        for debouncer in self._debouncers:
+            if debouncer is not None and not debouncer.isSettled():
+                return False
+        return True
+
+    def _parseIn(self, bank, state, timestamp):
+        """Informs the input devices on the pins that changed since the last
+        read. When nothing changed, this costs a single compare."""
+        if self._debouncers[bank] is not None:
+            self._debounceIn(bank, state, timestamp)
+            return
+        if state == self._lastread[bank]:
+            return
+        self._lastread[bank] = state
+
+        changed = (state ^ self._instate[bank]) & self._directions[bank]
+        if not changed:
+            # Only output pins changed
+            return
+        self._instate[bank] ^= changed
+
+        if logger.isEnabledFor(logging.DEBUG):
+            # Not formatted in the hot path when not debugging (% formatting
+            # has no binary conversion, so it can not be deferred)
+            logger.debug("0x{:02X} - bank {} inputs changed 0b{:08b} 0b{:08b}".format(
+                self._address, bank, state, changed))
+        for (device, pin) in self._changetable[bank][changed]:
+            device.inform(state & pin, timestamp)
+
+    def _debounceIn(self, bank, state, timestamp):
+        """Like _parseIn(), for a bank with debounced inputs: only informs the
+        input devices of the changes accepted by the debouncer, with the
+        moment their level was first read."""
+        debouncer = self._debouncers[bank]
+        (accepted, glitches) = debouncer.update(
+            state & self._directions[bank], timestamp)
+        if glitches:
+            for (device, pin) in self._changetable[bank][glitches]:
+                device.addGlitch()
+        if accepted:
+            self._instate[bank] ^= accepted
+            state = debouncer.state
+            for (device, pin) in self._changetable[bank][accepted]:
+                device.inform(state & pin, debouncer.since(pin))
 
 
 class Mcp23017OutGameDevice(OutGameDevice):
@@ -197,4 +386,3 @@ class Mcp23017InGameDevice(InGameDevice):
         InGameDevice.__init__(self, name, hwdevice, **kwargs)
         self.pin = (1 << pin)
         self.bank = bank   # pin on Bank A or Bank B
-        self.oldstate = 0  # Known state, variable controlled by Mcp23017
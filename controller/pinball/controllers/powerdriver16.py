@@ -1,8 +1,16 @@
+import logging
 import os
 import serial
+import threading
+import time
 
+from pinball import clock
+from pinball import latency
 from pinball.controllers.hwgamedevice import OutGameDevice
 from pinball.controllers.hwcontroller import HWController
+from pinball.profiler import Histogram
+
+logger = logging.getLogger(__name__)
 
 
 """
@@ -14,35 +22,195 @@ Notes:
     - Application to be executed on the Arduino can be found in
       projectroot/powerdriver_16_arduino/
 
-    - Communication protocol works when:
-       1) Powering up the RaspberryPi
-       2) Powering up the Aruidno (after 1 is finished)
-       3) Starting the pinball application
+    - Boards: up to MAX_BOARDS PowerDriver16 boards are chained on the SPI
+      bus of the Arduino, addressed by their board number (0..boards-1).
+      Each board has two banks (A: 0, B: 1) of 8 outputs.
+
+    - Handshake: the host sends
+      "\\r\\nMY MAGIC PINBALL <baudrate> <boards>\\r\\n", the Arduino
+      replies "OK <baudrate> <boards>\\r\\n" and both switch to that
+      baudrate. The host first tries the handshake at the requested baudrate
+      (the Arduino may still be running at it), then at 9600 baud. Without
+      a reply, the host falls back to 9600 baud and a single board (the
+      settings of a freshly reset Arduino), logs an error and reports it in
+      getLinkStats(). Outputs on the other boards are then rejected.
+
+    - Packets (both directions):
+
+        SYNC LEN SEQ CMD PAYLOAD[LEN] CHK
+
+        SYNC: 0xA5
+        LEN:  payload length
+        SEQ:  sequence number (0..255), increased by one per host packet
+        CMD:  command
+        CHK:  ~(LEN + SEQ + CMD + PAYLOAD) & 0xFF
 
-       , but is also not yet properly implemented debugged.
+      Commands:
+        WRITE (0x01): PAYLOAD is a list of (board, bank, value) triples, so
+                      all dirty banks of all boards are sent in one packet.
+        PULSE (0x02): PAYLOAD is a list of (board, bank, mask, ms) entries:
+                      the Arduino turns the pins in mask on, and turns them
+                      off again after ms (1..255) milliseconds. Pulsing pins
+                      are on regardless of the WRITE value of their bank. An
+                      entry with ms 0 ends the pulses of the pins in mask
+                      right away (a deactivate() during a pulse).
+        ACK   (0x81): Arduino -> host, acknowledges all packets up to the
+                      one with SEQ. PAYLOAD: (checksum errors, dropped
+                      packets) as seen by the Arduino, followed by the number
+                      of SPI bank transfers per board. All counters modulo
+                      256.
+
+      The Arduino drops packets with a bad checksum, and packets that stall
+      for 20ms (so noise with a SYNC byte can not swallow the next
+      handshake line), and waits for the next SYNC byte. Its SoftwareSerial port can not receive while it transmits,
+      so it does not ACK every packet: it sends one ACK for the last packet
+      once the line is idle (no bytes for 0.5ms). The host therefore takes
+      the dropped packets and checksum errors from the counters of the
+      Arduino, and measures the latency of the last packet of a burst only
+      (write to ACK, including the idle time and the SPI transfers).
+
+    - SPI: the Arduino only transfers a bank to its board when its output
+      value (bank value plus pulsing pins) changed, in one pass over all
+      boards per loop. All banks are refreshed every 100ms, so a board that
+      missed a transfer recovers. The time from packet to SPI transfer does
+      therefore not grow with the number of boards, see getLinkStats() for
+      the update rates per board.
+
+    - Background writer: by default the packets are written by a dedicated
+      thread, so the game loop never waits on the UART. commit() only puts
+      the latest state of each dirty bank in a mailbox; a state that was not
+      yet sent is overwritten by a newer one instead of being queued. A bank
+      change is therefore on the wire after at most the packet that is being
+      written plus its own packet (each at most MAX_PAYLOAD + 5 bytes, about
+      11 ms at 57600 baud), regardless of the game load. When a write
+      fails, the bank states go back into the mailbox (unless a newer state
+      was posted meanwhile) and are retried after WRITE_RETRY seconds, as
+      are the pulse cancels. Pulses are not retried, a late kick is worse
+      than none: they are counted in getLinkStats(). The writer reports
+      the output changes to the latency tracer (see pinball.latency) once
+      their packets are written to the serial port.
 """
 
 
 class PowerDriver16(HWController):
 
-    def __init__(self, deviceAddress):
+    MAGIC = "MY MAGIC PINBALL"
+    HANDSHAKE_BAUDRATE = 9600
+
+    SYNC = 0xA5
+    CMD_WRITE = 0x01
+    CMD_PULSE = 0x02
+    CMD_ACK = 0x81
+    MAX_PAYLOAD = 60  # Bytes, the Arduino serial buffer is 64 bytes
+    MAX_BOARDS = 8
+    WRITE_RETRY = 0.1  # Time (s) before a failed background write is retried
+
+    def __init__(self, deviceAddress, baudrate=57600, background=True,
+                 boards=1):
+        """Constructor.
+        @param deviceAddress Serial device
+        @param baudrate Baudrate to negotiate with the Arduino
+        @param background Write packets from a background thread
+        @param boards Number of boards chained on the Arduino
+        """
         HWController.__init__(self)
 
         if not os.path.exists(deviceAddress):
-            raise RuntimeError("""Serial device "{}" not found, PowerDriver16 will not work.""".format(serial_device_file))
+            raise RuntimeError("""Serial device "{}" not found, PowerDriver16 will not work.""".format(deviceAddress))
+
+        if not 1 <= boards <= self.MAX_BOARDS:
+            raise ValueError("PowerDriver16 supports 1 to {} boards".format(
+                self.MAX_BOARDS))
+
+        self.bus = deviceAddress
+        self._boards = boards
 
         # Initialize Communication
-        self._serial = serial.Serial(deviceAddress, 9600)
-        self._serial.write("MY MAGIC PINBALL\r\n".encode())
+        self._serial = serial.Serial(deviceAddress, baudrate, timeout=0.5)
+        self._handshake(baudrate)
+        self._serial.timeout = 0
 
         self._values = {}
         self._dirtyBanks = set()
+        self._pulses = []  # (board, bank, mask, ms) to send next commit
+        self._pulsing = {}  # Per (board, bank) the pins pulsed by the Arduino
         self._devices = []
 
+        # Link state and statistics
+        self._seq = 0
+        self._sent = [None] * 256     # Send time per sequence number
+        self._rx = bytearray()
+        self.packets = 0
+        self.bytes = 0
+        self.acks = 0
+        self.writeErrors = 0          # Failed background writes
+        self.lostPulses = 0           # Pulses dropped by failed writes
+        self.dropped = 0              # Reported by the Arduino (ACKs)
+        self.checksumErrors = 0       # Reported by the Arduino (ACKs)
+        self._linkCounters = None     # Last reported counters (mod 256)
+        self.latency = Histogram()    # Acknowledged packet write to ACK (ns)
+        self.queueAge = Histogram()   # Mailbox post to packet write (ns)
+        boards = self._boards  # One board if the handshake failed
+        self.boardUpdates = [0] * boards   # Bank updates sent per board
+        self.boardTransfers = [0] * boards  # SPI transfers per board (ACKs)
+        self._transfers = None        # Last reported counters (mod 256)
+
+        # Last (time, bytes, board updates, board transfers) for the rates
+        self._rate = (clock.now(), 0, [0] * boards, [0] * boards)
+
+        # Mailbox with the latest unsent state per (board, bank), the time
+        # the oldest state in it was posted, the output changes to report to
+        # the latency tracer once sent, and the writer thread.
+        self._mailbox = {}
+        self._mailboxPulses = []
+        self._mailboxSince = None
+        self._mailboxTraced = []
+        self._mailboxLock = threading.Condition()
+        self._writer = None
+        if background:
+            self.tracesCommit = True
+            self._writer = threading.Thread(
+                target=self._writeLoop, name="PowerDriver16 writer")
+            self._writer.daemon = True
+            self._writer.start()
+
+    def _handshake(self, baudrate):
+        """Negotiates the baudrate with the Arduino, see the notes above.
+        Sets handshakeOk."""
+        for rate in (baudrate, self.HANDSHAKE_BAUDRATE):
+            self._serial.baudrate = rate
+            self._serial.reset_input_buffer()
+            self._serial.write("\r\n{} {} {}\r\n".format(
+                self.MAGIC, baudrate, self._boards).encode())
+            reply = self._serial.readline().decode(errors="replace").strip()
+            if reply == "OK {} {}".format(baudrate, self._boards):
+                self._serial.baudrate = baudrate
+                logger.info("{} connected at {} baud, {} board(s)".format(
+                    self.bus, baudrate, self._boards))
+                self.handshakeOk = True
+                return
+        logger.error("{}: no handshake reply, falling back to {} baud and "
+                     "1 of {} board(s)".format(
+                         self.bus, self.HANDSHAKE_BAUDRATE, self._boards))
+        self._serial.baudrate = self.HANDSHAKE_BAUDRATE
+        self._boards = 1
+        self.handshakeOk = False
+
     def getHwDevices(self):
         return self._devices
 
     def getOut(self, name, board, bank, pin):
+        """Returns an output device on the given pin.
+        @param board Board number (0..boards-1)
+        @param bank Bank of the board (0: A, 1: B)
+        @param pin Pin number of the bank (0..7)
+        """
+        if not (0 <= board < self._boards and bank in (0, 1) and
+                0 <= pin < 8):
+            raise ValueError(
+                "No output board {} bank {} pin {} on {}{}".format(
+                    board, bank, pin, self.bus,
+                    "" if self.handshakeOk else " (no handshake, 1 board)"))
         if (board, bank) not in self._values:
             self._values[(board, bank)] = 0x00
         self._dirtyBanks.add((board, bank))
@@ -56,17 +224,235 @@ class PowerDriver16(HWController):
         bank = device.bank
         self._dirtyBanks.add((board, bank))
         self._values[(board, bank)] |= device.pin
+        # The pin stays on when a running pulse ends
+        self._endPulse(board, bank, device.pin)
 
     def deactivate(self, device):
         board = device.board
         bank = device.bank
         self._dirtyBanks.add((board, bank))
         self._values[(board, bank)] &= (~device.pin)
+        if self._endPulse(board, bank, device.pin):
+            # Cut the pulse short
+            self._pulses.append((board, bank, device.pin, 0))
+
+    def pulse(self, device, ms):
+        """The pulse is timed by the Arduino. The pin is cleared in the bank
+        value, so it is off when the pulse is over, also when it was
+        activated before the pulse. A deactivate() cuts the pulse short."""
+        board = device.board
+        bank = device.bank
+        ms = min(255, max(1, int(ms)))
+        self._pulses.append((board, bank, device.pin, ms))
+        self._pulsing[(board, bank)] = \
+            self._pulsing.get((board, bank), 0) | device.pin
+        if self._values[(board, bank)] & device.pin:
+            # Only costs a WRITE when the pin was activated before
+            self._values[(board, bank)] &= (~device.pin)
+            self._dirtyBanks.add((board, bank))
+
+    def endPulse(self, device):
+        """The Arduino ended the pulse itself."""
+        self._endPulse(device.board, device.bank, device.pin)
 
-    def sync(self):
-        for (board, bank) in self._dirtyBanks:
-            self._serial.write([board, bank, self._values[(board, bank)]])
+    def _endPulse(self, board, bank, pin):
+        """Forgets the pulse of the pin, returns True if it was pulsing."""
+        pulsing = self._pulsing.get((board, bank), 0)
+        if not pulsing & pin:
+            return False
+        self._pulsing[(board, bank)] = pulsing & ~pin
+        return True
+
+    def commit(self):
+        if not self._dirtyBanks and not self._pulses:
+            return
+
+        values = self._values
+        updates = {key: values[key] for key in self._dirtyBanks}
         self._dirtyBanks.clear()
+        pulses = self._pulses
+        self._pulses = []
+
+        if self._writer is None:
+            self._write(updates, pulses)
+            return
+
+        tracer = latency.getTracer()
+        traced = tracer.take(self) if tracer.enabled else None
+
+        with self._mailboxLock:
+            if not self._mailbox and not self._mailboxPulses:
+                self._mailboxSince = clock.now()
+            self._mailbox.update(updates)
+            self._mailboxPulses += pulses
+            if traced:
+                self._mailboxTraced += traced
+            self._mailboxLock.notify()
+
+    def _writeLoop(self):
+        """Writer thread, writes the mailbox contents whenever available."""
+        lock = self._mailboxLock
+        while True:
+            with lock:
+                while not self._mailbox and not self._mailboxPulses:
+                    lock.wait()
+                updates = self._mailbox
+                pulses = self._mailboxPulses
+                since = self._mailboxSince
+                traced = self._mailboxTraced
+                self._mailbox = {}
+                self._mailboxPulses = []
+                self._mailboxTraced = []
+
+            self.queueAge.add(clock.now() - since)
+            try:
+                self._write(updates, pulses)
+            except Exception:
+                self.writeErrors += 1
+                logger.exception("{}: write failed, retrying".format(
+                    self.bus))
+                self._requeue(updates, pulses, since, traced)
+                time.sleep(self.WRITE_RETRY)
+                continue
+            if traced:
+                # The output changes are on the wire now
+                latency.getTracer().complete(traced)
+
+    def _requeue(self, updates, pulses, since, traced):
+        """Puts the contents of a failed write back in the mailbox, without
+        overwriting the states that were posted meanwhile."""
+        cancels = [pulse for pulse in pulses if pulse[3] == 0]
+        self.lostPulses += len(pulses) - len(cancels)
+        with self._mailboxLock:
+            for (key, value) in updates.items():
+                self._mailbox.setdefault(key, value)
+            self._mailboxPulses[:0] = cancels
+            self._mailboxTraced[:0] = traced
+            if since is not None:
+                self._mailboxSince = since
+
+    def _write(self, updates, pulses):
+        """Sends the {(board, bank): value} updates and the pulses in as few
+        packets as possible."""
+        payload = bytearray()
+        for (board, bank) in sorted(updates):
+            payload += bytes((board, bank, updates[(board, bank)]))
+            self.boardUpdates[board] += 1
+        for start in range(0, len(payload), self.MAX_PAYLOAD):
+            self._send(self.CMD_WRITE, payload[start:start + self.MAX_PAYLOAD])
+
+        payload = bytearray()
+        for pulse in pulses:
+            payload += bytes(pulse)
+        for start in range(0, len(payload), self.MAX_PAYLOAD):
+            self._send(self.CMD_PULSE, payload[start:start + self.MAX_PAYLOAD])
+
+    def _send(self, command, payload):
+        seq = self._seq
+        packet = bytearray((self.SYNC, len(payload), seq, command))
+        packet += payload
+        packet.append(~sum(packet[1:]) & 0xFF)
+
+        self._sent[seq] = clock.now()
+        self._serial.write(packet)
+        # Not counted by the Arduino as dropped when the write failed
+        self._seq = (seq + 1) & 0xFF
+        self.packets += 1
+        self.bytes += len(packet)
+
+    def sample(self):
+        """Processes the ACKs received from the Arduino."""
+        waiting = self._serial.in_waiting
+        if not waiting:
+            return
+
+        rx = self._rx
+        rx += self._serial.read(waiting)
+        now = clock.now()
+        while True:
+            start = rx.find(self.SYNC)
+            if start < 0:
+                del rx[:]
+                return
+            del rx[:start]
+            if len(rx) < 2:
+                return
+            if rx[1] > self.MAX_PAYLOAD:
+                # Not a packet start, resync on the next SYNC byte
+                del rx[:1]
+                continue
+            if len(rx) < rx[1] + 5:
+                return
+
+            packet = rx[:rx[1] + 5]
+            if sum(packet[1:]) & 0xFF != 0xFF:
+                # Bad checksum, resync on the next SYNC byte
+                del rx[:1]
+                continue
+            del rx[:len(packet)]
+            if packet[3] == self.CMD_ACK:
+                self._ack(packet[2], packet[4:-1], now)
+
+    def _ack(self, seq, payload, now):
+        """Processes an ACK of all packets up to seq, see the notes above."""
+        self.acks += 1
+        sent = self._sent[seq]
+        if sent is not None:
+            self._sent[seq] = None
+            self.latency.add(now - sent)
+
+        # Checksum errors and dropped packets, accumulate the modulo 256
+        # counters
+        if len(payload) >= 2:
+            counters = bytes(payload[:2])
+            if self._linkCounters is not None:
+                self.checksumErrors += \
+                    (counters[0] - self._linkCounters[0]) & 0xFF
+                self.dropped += (counters[1] - self._linkCounters[1]) & 0xFF
+            self._linkCounters = counters
+
+        # SPI transfers per board, accumulate the modulo 256 counters
+        transfers = payload[2:2 + self._boards]
+        if len(transfers) == self._boards:
+            if self._transfers is not None:
+                for (board, count) in enumerate(transfers):
+                    self.boardTransfers[board] += \
+                        (count - self._transfers[board]) & 0xFF
+            self._transfers = bytes(transfers)
+
+    def getLinkStats(self):
+        """Returns the serial link statistics: whether the handshake succeeded
+        and the baudrate in use, packets and bytes sent, bytes/s since the
+        previous call, ACKs received, failed background writes and the pulses
+        they lost, packets dropped and checksum errors (reported by the
+        Arduino), the packet latency (ns), the age of states in the writer
+        mailbox (ns), and per board the bank updates sent and the SPI
+        transfers of the Arduino per second."""
+        now = clock.now()
+        (since, sent, updates, transfers) = self._rate
+        self._rate = (now, self.bytes, list(self.boardUpdates),
+                      list(self.boardTransfers))
+        seconds = max(1, now - since) / 1e9
+        return {
+            "handshake": self.handshakeOk,
+            "baudrate": self._serial.baudrate,
+            "packets": self.packets,
+            "bytes": self.bytes,
+            "bytesPerSecond": (self.bytes - sent) / seconds,
+            "acks": self.acks,
+            "writeErrors": self.writeErrors,
+            "lostPulses": self.lostPulses,
+            "dropped": self.dropped,
+            "checksumErrors": self.checksumErrors,
+            "latency": self.latency.summary(),
+            "queueAge": self.queueAge.summary(),
+            "boards": [
+                {"updatesPerSecond": (self.boardUpdates[board] -
+                                      updates[board]) / seconds,
+                 "transfersPerSecond": (self.boardTransfers[board] -
+                                        transfers[board]) / seconds}
+                for board in range(self._boards)],
+        }
 
     # def __str__(self):
     #     return "[{0} {1}] [ {2:08b} ]".format(
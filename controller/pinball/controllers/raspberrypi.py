@@ -1,3 +1,7 @@
+from collections import deque
+
+from pinball import clock
+from pinball.controllers.debounce import BankDebouncer
 from pinball.controllers.hwgamedevice import InGameDevice
 from pinball.controllers.hwcontroller import HWController
 
@@ -14,31 +18,147 @@ class RaspberryPiInGameDevice(InGameDevice):
 
 class RaspberryPi(HWController):
 
-    """Represents a Raspberry Pi on which THIS software is running"""
+    """Represents a Raspberry Pi on which THIS software is running
+
+    By default all input pins are polled every frame. With edgeDetect=True
+    the inputs use the edge detection of the GPIO library instead: the GPIO
+    callback thread timestamps every edge and appends it to a queue, and
+    sample() only drains that queue. Pulses shorter than a frame are not
+    lost this way. Single pins can still be polled with getIn(..., poll=True).
+
+    Inputs can be debounced per pin (see pinball.controllers.debounce). All
+    debounced pins are filtered together by a single BankDebouncer, with a
+    bit per pin. For edge detected pins the edges are the samples, so only
+    their stableTime setting is useful.
+    """
+
+    bus = "gpio"
 
-    def __init__(self):
+    def __init__(self, edgeDetect=False):
         HWController.__init__(self)
-        self._devices = {}  # map of (InGameDevice, oldstate)
+        self._edgeDetect = edgeDetect
+        self._devices = {}  # map of (InGameDevice, oldstate), polled pins
+        self._edgeDevices = {}  # map of InGameDevice, edge detected pins
+        self._levels = {}  # Last level reported by the GPIO callback per pin
+        self._ahead = {}  # Per pin the edges reported before their callback
+
+        # Debounced pins: map of (InGameDevice, poll), their raw levels (bit
+        # per pin) and their debouncer
+        self._debounced = {}
+        self._raw = 0
+        self._debouncer = BankDebouncer()
+
+        # Queue of (pin, level, timestamp) edges. Appended by the GPIO
+        # callback thread, popped by the game loop (deque is thread-safe for
+        # a single producer and consumer).
+        self._edges = deque()
 
     def getHwDevices(self):
-        return list([x[0] for x in self._devices.values()])
+        return list([x[0] for x in self._devices.values()]) + \
+            list(self._edgeDevices.values()) + \
+            list([x[0] for x in self._debounced.values()])
 
-    def getIn(self, name, pin, **kwargs):
+    def getIn(self, name, pin, poll=None, debounce=1, stableTime=0,
+              **kwargs):
+        """Returns an input device on the given (BCM) pin.
+        @param poll Poll the pin every frame instead of using edge detection,
+                    defaults to the edgeDetect setting of the controller
+        @param debounce Number of consecutive polls the input must be stable
+                        before a change is reported
+        @param stableTime Minimum time (s) the input must be stable before a
+                          change is reported
+        """
         if(pin == -1):
             # dummy
             return RaspberryPiInGameDevice(name, self, -1, **kwargs)
 
-        if(pin in self._devices):
+        if(pin in self._devices or pin in self._edgeDevices or
+           pin in self._debounced):
             raise Exception("Pin was already instanciated!")
 
         # Create device, default off
-        self._devices[pin] = (RaspberryPiInGameDevice(
-            name, self, pin, **kwargs), 0)
+        device = RaspberryPiInGameDevice(name, self, pin, **kwargs)
         GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-        return self._devices[pin][0]
 
-    def sync(self):
+        if poll is None:
+            poll = not self._edgeDetect
+        if debounce > 1 or stableTime > 0:
+            self._debounced[pin] = (device, poll)
+            self._debouncer.configure(1 << pin, debounce, stableTime)
+            if not poll:
+                self._levels[pin] = GPIO.input(pin)
+                self._edges.append((pin, self._levels[pin], clock.now()))
+                GPIO.add_event_detect(pin, GPIO.BOTH, callback=self._edge)
+        elif poll:
+            self._devices[pin] = (device, 0)
+        else:
+            self._edgeDevices[pin] = device
+            self._levels[pin] = GPIO.input(pin)
+            self._edges.append((pin, self._levels[pin], clock.now()))
+            GPIO.add_event_detect(pin, GPIO.BOTH, callback=self._edge)
+        return device
+
+    def _edge(self, pin):
+        """Called by the GPIO library (in its own thread) on every edge."""
+        now = clock.now()
+        level = GPIO.input(pin)
+        if level == self._levels[pin]:
+            if self._ahead.get(pin):
+                # The edge of this callback was already reported
+                self._ahead[pin] -= 1
+                return
+            # The pin already returned to its old level (a pulse shorter than
+            # the callback latency), report both edges. The callback of the
+            # second edge is still to come.
+            self._edges.append((pin, not level, now))
+            self._ahead[pin] = self._ahead.get(pin, 0) + 1
+        self._levels[pin] = level
+        self._edges.append((pin, level, now))
+
+    def commit(self):
+        pass
+
+    def sample(self):
+        now = None
         for pin, (device, oldstate) in self._devices.items():
             if GPIO.input(pin) != oldstate:
+                if now is None:
+                    now = clock.now()
                 self._devices[pin] = (device, not oldstate)
-                device.inform(not oldstate)
+                device.inform(not oldstate, now)
+
+        edges = self._edges
+        while edges:
+            (pin, level, timestamp) = edges.popleft()
+            if pin in self._edgeDevices:
+                self._edgeDevices[pin].inform(level, timestamp)
+            else:
+                self._setRaw(pin, level)
+                self._debounce(timestamp)
+
+        if self._debounced:
+            for (pin, (device, poll)) in self._debounced.items():
+                if poll:
+                    self._setRaw(pin, GPIO.input(pin))
+            self._debounce(clock.now())
+
+    def _setRaw(self, pin, level):
+        if level:
+            self._raw |= 1 << pin
+        else:
+            self._raw &= ~(1 << pin)
+
+    def _debounce(self, now):
+        """Feeds the raw levels of the debounced pins to the debouncer, and
+        informs the devices of the accepted changes."""
+        debouncer = self._debouncer
+        (accepted, glitches) = debouncer.update(self._raw, now)
+        if not (accepted or glitches):
+            return
+        for (pin, (device, _)) in self._debounced.items():
+            mask = 1 << pin
+            if glitches & mask:
+                device.addGlitch()
+            if accepted & mask:
+                device.inform(bool(debouncer.state & mask),
+                              debouncer.since(mask))
@@ -0,0 +1,153 @@
+import logging
+
+from pinball import clock
+from pinball.controllers.hwgamedevice import OutGameDevice, InGameDevice
+from pinball.controllers.hwcontroller import HWController
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Simulation controller
+
+Input trace: a text file with one input change per line
+
+    <time> <level> <input name>
+
+    time:  seconds (engine clock) since the start of the simulation
+    level: 0 or 1, the raw (not inverted) level of the input
+    Empty lines and lines starting with '#' are ignored.
+
+e.g.:
+
+    # Left flipper button press of 100ms
+    0.500 1 L Flipper button
+    0.600 0 L Flipper button
+
+Output trace: the output changes as written by commit(), in the same format.
+Run on a VirtualClock, the output trace of a simulation is deterministic, so
+the traces of two runs can be diffed.
+"""
+
+
+def readTrace(lines):
+    """Parses the lines of an input trace, returns a sorted list of
+    (time (ns), level, name) tuples."""
+    trace = []
+    for (number, line) in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            (t, level, name) = line.split(None, 2)
+            trace.append((round(float(t) * 1e9), level != "0", name))
+        except ValueError:
+            raise ValueError("Invalid trace line {}: {}".format(number, line))
+    trace.sort(key=lambda entry: entry[0])
+    return trace
+
+
+def formatTrace(trace):
+    """Returns the lines of a trace of (time (ns), level, name) tuples."""
+    return ["{:.6f} {:d} {}".format(t / 1e9, level, name)
+            for (t, level, name) in trace]
+
+
+class SimulationController(HWController):
+
+    """
+    HW Controller that replays an input trace, and records the changes of its
+    outputs (see the trace format above). Inputs and outputs are identified
+    by name. Inputs are sampled in the first frame at or after their time in
+    the trace, and are informed with their trace time as timestamp.
+    """
+
+    def __init__(self, trace=()):
+        """Constructor.
+        @param trace Input trace, a list of (time (ns), level, name) tuples
+                     (see readTrace())
+        """
+        HWController.__init__(self)
+        self._inputs = {}
+        self._devices = []
+        self._trace = sorted(trace, key=lambda entry: entry[0])
+        self._next = 0  # Index of the next trace entry
+
+        self._pending = {}  # Output changes since the last commit
+        self._levels = {}   # Last committed level per output
+        self.output = []    # Output trace, (time (ns), level, name) tuples
+
+    @classmethod
+    def fromFile(cls, path):
+        with open(path) as f:
+            return cls(readTrace(f))
+
+    def getHwDevices(self):
+        return self._devices[:]
+
+    def getIn(self, name, **kwargs):
+        if name in self._inputs:
+            raise Exception("Input was already instanciated!")
+        inDevice = SimulationInGameDevice(name, self, **kwargs)
+        self._inputs[name] = inDevice
+        self._devices.append(inDevice)
+        return inDevice
+
+    def getOut(self, name):
+        outDevice = SimulationOutGameDevice(name, self)
+        self._levels[outDevice] = False
+        self._devices.append(outDevice)
+        return outDevice
+
+    def getNextInputTime(self):
+        if self._next < len(self._trace):
+            return self._trace[self._next][0]
+        return float("inf")
+
+    def getLastInputTime(self):
+        """Returns the time (ns) of the last input change of the trace."""
+        return self._trace[-1][0] if self._trace else 0
+
+    def isFinished(self):
+        """Returns True when the complete input trace was replayed."""
+        return self._next >= len(self._trace)
+
+    def commit(self):
+        if not self._pending:
+            return
+        now = clock.now()
+        for (device, level) in self._pending.items():
+            if self._levels[device] != level:
+                self._levels[device] = level
+                self.output.append((now, level, device.getName()))
+        self._pending.clear()
+
+    def sample(self):
+        trace = self._trace
+        now = clock.now()
+        while self._next < len(trace) and trace[self._next][0] <= now:
+            (t, level, name) = trace[self._next]
+            self._next += 1
+            device = self._inputs.get(name)
+            if device is None:
+                logger.warning("trace: unknown input {}".format(name))
+                continue
+            device.inform(level, t)
+
+    def activate(self, outDevice):
+        self._pending[outDevice] = True
+
+    def deactivate(self, outDevice):
+        self._pending[outDevice] = False
+
+
+class SimulationOutGameDevice(OutGameDevice):
+
+    def __init__(self, name, hwdevice):
+        OutGameDevice.__init__(self, name, hwdevice)
+
+
+class SimulationInGameDevice(InGameDevice):
+
+    def __init__(self, name, hwdevice, **kwargs):
+        InGameDevice.__init__(self, name, hwdevice, **kwargs)
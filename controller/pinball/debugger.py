@@ -1,3 +1,4 @@
+import json
 import logging
 import tornado
 import tornado.ioloop
@@ -5,22 +6,85 @@ import tornado.web
 import tornado.websocket
 import threading
 
+from pinball.e_observable import subscriptionCount
+
 logger = logging.getLogger(__name__)
 
 
-class DebugEngine():
+class DebugClients():
+
+    """The websocket clients of a debugger, only used by the IOLoop thread.
+    Subclasses implement snapshot()."""
+
+    def __init__(self):
+        self._clients = set()
+
+    def _broadcast(self, kind, data):
+        for client in list(self._clients):
+            client.post(kind, data)
+
+    def addClient(self, client):
+        self._clients.add(client)
+        client.post("S", self.snapshot())
+
+    def removeClient(self, client):
+        self._clients.discard(client)
+
+    def snapshot(self):
+        """Returns the [name, state] of all devices."""
+        raise NotImplementedError
+
+
+class DebugEngine(DebugClients):
+
+    """
+    Debugger web GUI, served by a Tornado IOLoop in its own thread.
+
+    The game thread only collects: it observes all devices, the FPS counter
+    and the profiler once (not per client), and accumulates the device
+    changes. Every interval (0 means every frame) the changes are handed to
+    the IOLoop thread as one delta with add_callback, which is thread-safe
+    and does not block. All websocket writes, and the JSON encoding, are
+    done by the IOLoop thread.
+
+    Messages to the GUI:
+        S:[[name, state], ...]   snapshot of all devices, sent on connect.
+                                 The device index is the list index.
+        D:[index, state, ...]    delta of the devices that changed
+        FPS:<fps>, SUBS:<n>, PERF:<json>, LAT:<json>
+
+    A client that did not finish receiving the previous message gets no new
+    one: its deltas are merged (only the last state per device is kept) and
+    of the other messages only the last one is kept, until the client is
+    ready. A slow client thus never slows the game loop or the other clients.
+    """
 
-    def __init__(self, gameengine):
+    def __init__(self, gameengine, interval=0.02):
+        """Constructor.
+        @param interval Time (s) between device updates, 0 for every frame
+        """
+        DebugClients.__init__(self)
         self._gameengine = gameengine
+        self._interval = interval
+        self._ioloop = None
+        self._changes = {}  # Only used by the game thread
 
     def start(self):
         self._devices = self._gameengine._hwengine.getHwDevices()
-        self._gamelogic = self._gameengine._gamelogic
+        self._index = {device: index
+                       for (index, device) in enumerate(self._devices)}
 
         guiapp = self.make_gui()
         guiapp.listen(8888)
+        self._ioloop = tornado.ioloop.IOLoop.current()
 
-        t = threading.Thread(target=tornado.ioloop.IOLoop.current().start)
+        for device in self._devices:
+            device.observe(self, self._deviceupdate)
+        self._gameengine._fps.observe(self, self._fpsupdate)
+        self._gameengine._profiler.observe(self, self._perfupdate)
+        self._gameengine._timers.schedule(self._interval, self._flush)
+
+        t = threading.Thread(target=self._ioloop.start)
         t.daemon = True
         logger.info("debugger started at http://localhost:8888")
         t.start()
@@ -28,46 +92,112 @@ class DebugEngine():
     def make_gui(self):
         return tornado.web.Application([
             (r"/", PinballPage),
-            (r"/websocket", DebugWebSocket, {
-                "devices": self._devices,
-                "gamelogic": self._gamelogic,
-                "fps": self._gameengine._fps
-              })
+            (r"/latency", LatencyExport, {
+                "latency": self._gameengine._latency
+              }),
+            (r"/websocket", DebugWebSocket, {"debugger": self})
         ], debug=True)
 
+    # Game thread
 
-class DebugWebSocket(tornado.websocket.WebSocketHandler):
-    """Communication channel with the webpage"""
+    def _deviceupdate(self, device, state=None):
+        self._changes[self._index[device]] = 1 if state else 0
 
-    def initialize(self, devices, gamelogic, fps):
-        self._devices = devices
-        self._gamelogic = gamelogic
-        fps.observe(self, self._fpsupdate)
+    def _flush(self, lateness):
+        self._gameengine._timers.schedule(self._interval, self._flush)
+        if self._changes:
+            changes = self._changes
+            self._changes = {}
+            self._ioloop.add_callback(self._broadcast, "D", changes)
+
+    def _fpsupdate(self, fps, count):
+        self._ioloop.add_callback(self._broadcast, "FPS", count)
+        self._ioloop.add_callback(
+            self._broadcast, "SUBS", subscriptionCount())
+
+    def _perfupdate(self, profiler, report):
+        self._ioloop.add_callback(self._broadcast, "PERF", report)
+        latency = self._gameengine._latency
+        if latency.enabled:
+            self._ioloop.add_callback(
+                self._broadcast, "LAT", latency.summary())
+
+    # IOLoop thread
+
+    def snapshot(self):
+        return [[device.getName(), 1 if device.isActivated() else 0]
+                for device in self._devices]
 
-    def _deviceupdate(self, d, *args, **kwargs):
-        """Sends device status updates to the GUI"""
-        try:
-            self.write_message("D:{}:{}:{}".format(
-                1 if d.isActivated() else 0, id(d), d.getName()))
-        except:
-            pass
 
-    def _fpsupdate(self, device, fps):
+class DebugWebSocket(tornado.websocket.WebSocketHandler):
+    """Communication channel with the webpage, see DebugEngine. Only used by
+    the IOLoop thread."""
+
+    def initialize(self, debugger):
+        self._debugger = debugger
+        self._writing = None  # Future of the message being written
+        self._backlog = {}    # Messages waiting for the client, per kind
+
+    def post(self, kind, data):
+        """Sends the message, or queues it when the client is still busy."""
+        backlog = self._backlog
+        if kind == "D" and "D" in backlog:
+            backlog["D"].update(data)
+        elif kind == "D":
+            backlog["D"] = dict(data)
+        else:
+            if kind == "S":
+                # The snapshot supersedes the queued changes
+                backlog.pop("D", None)
+            # Sent in the order of arrival of the latest message per kind
+            backlog.pop(kind, None)
+            backlog[kind] = data
+        if self._writing is None:
+            self._send()
+
+    def _send(self, future=None):
+        self._writing = None
+        if not self._backlog:
+            return
+        # Oldest first (popitem() would take the newest)
+        kind = next(iter(self._backlog))
+        data = self._backlog.pop(kind)
+        if kind == "D":
+            message = "D:" + json.dumps(
+                [x for change in sorted(data.items()) for x in change])
+        elif kind in ("S", "PERF", "LAT"):
+            message = "{}:{}".format(kind, json.dumps(data))
+        else:
+            message = "{}:{}".format(kind, data)
         try:
-            self.write_message("FPS:{}".format(fps))
-        except:
-            pass
+            self._writing = self.write_message(message)
+        except tornado.websocket.WebSocketClosedError:
+            return
+        if self._writing is not None:
+            self._writing.add_done_callback(self._send)
+        else:
+            self._send()
 
     def open(self):
         logger.debug("WebSocket opened")
-        for d in self._devices:
-            d.observe(self, self._deviceupdate)
-            self._deviceupdate(d)
+        self._debugger.addClient(self)
 
     def on_close(self):
         logger.debug("WebSocket closed")
-        for d in self._devices:
-            d.deobserve(self, self._deviceupdate)
+        self._debugger.removeClient(self)
+        self._backlog.clear()
+
+
+class LatencyExport(tornado.web.RequestHandler):
+    """Serves the input to output latency summaries as JSON"""
+
+    def initialize(self, latency):
+        self._latency = latency
+
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(self._latency.summary(), indent=2,
+                              sort_keys=True))
 
 
 class PinballPage(tornado.web.RequestHandler):
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+Out of process debugger: serves the debugger GUI from a separate process,
+fed by the shared state file the game process writes (see
+pinball.sharedstate). The game process does no JSON or HTTP work at all, and
+the debugger can be stopped and restarted at any time without touching the
+game or the hardware:
+
+    python3 -m pinball.debugserver [PATH] [--port PORT] [--interval SECONDS]
+
+Started by the game engine with GameEngine(..., debugger="process").
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+
+import tornado.ioloop
+import tornado.web
+
+from pinball.debugger import DebugClients, DebugWebSocket, PinballPage
+from pinball.sharedstate import SharedStateReader, SharedStateWriter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = "/dev/shm/pinball"
+
+
+class DebugProcess():
+
+    """Game process side: writes the shared state, and starts the debug
+    server process."""
+
+    def __init__(self, gameengine, path=DEFAULT_PATH, port=8888,
+                 interval=0.02):
+        self._writer = SharedStateWriter(gameengine, path)
+        self._path = path
+        self._port = port
+        self._interval = interval
+        self._process = None
+
+    def start(self):
+        self._writer.start()
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "pinball.debugserver", self._path,
+             "--port", str(self._port), "--interval", str(self._interval)],
+            cwd=root, stdin=subprocess.DEVNULL)
+        logger.info("debugger process {} started at http://localhost:{}"
+                    .format(self._process.pid, self._port))
+
+
+class DebugServer(DebugClients):
+
+    """
+    Polls the shared state file every interval and sends the changes to the
+    websocket clients (same messages as DebugEngine). When the file is
+    replaced by a new game process, the clients get a new snapshot.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, interval=0.02):
+        DebugClients.__init__(self)
+        self._path = path
+        self._interval = interval
+        self._reader = None
+        self._head = 0
+        self._fps = None
+        self._seq = None
+
+    def start(self, port=8888):
+        app = tornado.web.Application([
+            (r"/", PinballPage),
+            (r"/websocket", DebugWebSocket, {"debugger": self})
+        ])
+        app.listen(port)
+        tornado.ioloop.PeriodicCallback(
+            self._poll, max(self._interval, 0.001) * 1000).start()
+        logger.info("debugger serving {} at http://localhost:{}".format(
+            self._path, port))
+        tornado.ioloop.IOLoop.current().start()
+
+    def _open(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        try:
+            self._reader = SharedStateReader(self._path)
+        except (OSError, ValueError):
+            return False
+        self._head = self._reader.ringHead()
+        self._fps = None
+        self._seq = None
+        logger.info("reading state of game process {}".format(
+            self._reader.pid))
+        return True
+
+    def snapshot(self):
+        if self._reader is None:
+            return []
+        return [list(x) for x in zip(self._reader.devices,
+                                     self._reader.states())]
+
+    def _poll(self):
+        reader = self._reader
+        if reader is None or reader.isStale():
+            if self._open():
+                self._broadcast("S", self.snapshot())
+            return
+
+        (records, self._head) = reader.events(self._head)
+        if records is None:
+            # Missed records, start over from the current states
+            self._broadcast("S", self.snapshot())
+        elif records:
+            self._broadcast("D", {device: state
+                                  for (_, device, state) in records})
+
+        fps = reader.fps()
+        if fps != self._fps:
+            self._fps = fps
+            self._broadcast("FPS", fps)
+            self._broadcast("SUBS", reader.subscriptions())
+
+        (report, seq) = reader.report()
+        if report is not None and seq != self._seq:
+            self._seq = seq
+            self._broadcast("PERF", report)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Out of process pinball debugger")
+    parser.add_argument("path", nargs="?", default=DEFAULT_PATH,
+                        help="shared state file")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--interval", type=float, default=0.02,
+                        help="time (s) between updates")
+    args = parser.parse_args(argv)
+    DebugServer(args.path, args.interval).start(args.port)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
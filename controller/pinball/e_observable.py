@@ -1,12 +1,103 @@
+import weakref
 
-from collections import defaultdict
+from pinball import clock
+from pinball.eventqueue import EventQueue
 
-# Variable that holds all events that need to be processed during the next
-# frame
-#
-# TODO This needs to be refactored. It is a global variable. Perhaps this could
-#      be moved to the game-engine?
-observerEvents = []
+# Queue that holds all events that need to be processed during the next frame.
+# The game engine binds its own queue on construction, see bindEventQueue().
+_eventqueue = EventQueue()
+
+# All observables that have (had) subscriptions, see subscriptionCount()
+_observables = weakref.WeakSet()
+
+
+def bindEventQueue(queue):
+    """Lets all observables push their events on the given queue. Returns the
+    previously bound queue."""
+    global _eventqueue
+    old = _eventqueue
+    _eventqueue = queue
+    return old
+
+
+def getEventQueue():
+    """Returns the queue on which the events are pushed."""
+    return _eventqueue
+
+
+def eventTime():
+    """Returns the timestamp (engine clock, ns) of the event that is being
+    processed. Outside event processing, the current time is returned.
+
+    Game devices should use this time for their timing rules, so the time
+    spent between the moment an event happened and its processing does not
+    matter."""
+    timestamp = _eventqueue.timestamp
+    if timestamp is None:
+        return clock.now()
+    return timestamp
+
+
+def subscriptionCount():
+    """Returns the number of live subscriptions of all observables, for
+    diagnostics (e.g. to detect observers that are never removed)."""
+    return sum(observable.getSubscriptionCount()
+               for observable in list(_observables))
+
+
+class Subscription():
+
+    """
+    The callback of an observer, called as callback(cause, state) to process
+    an event. Subscriptions are pushed on the event queue as the callback of
+    the event, so informing does not create any objects.
+
+    The observer is referenced weakly: once it is garbage collected, the
+    callback is not called anymore and the subscription is removed from its
+    observable. A callback that is a method of the observer is stored as a
+    function, so it does not keep the observer alive either. Note that other
+    callbacks (e.g. a lambda using the observer) still can. Observers that do
+    not support weak references (e.g. None) are referenced strongly.
+    """
+
+    __slots__ = ("_ref", "_observer", "_function", "_method", "__weakref__")
+
+    def __init__(self, observer, callback, onDead=None):
+        self._method = (observer is not None and
+                        getattr(callback, "__self__", None) is observer)
+        self._function = callback.__func__ if self._method else callback
+        self._observer = None
+        try:
+            self._ref = weakref.ref(observer, onDead)
+        except TypeError:
+            # Not weak referenceable, keep the observer itself
+            self._ref = None
+            self._observer = observer
+
+    def __call__(self, cause, state):
+        if self._ref is None:
+            observer = self._observer
+        else:
+            observer = self._ref()
+            if observer is None:
+                return
+        if self._method:
+            self._function(observer, cause, state)
+        else:
+            self._function(cause, state)
+
+    def isAlive(self):
+        return self._ref is None or self._ref() is not None
+
+    def matches(self, observer, callback):
+        if self._ref is None:
+            if self._observer is not observer:
+                return False
+        elif self._ref() is not observer:
+            return False
+        if self._method:
+            return getattr(callback, "__func__", None) is self._function
+        return callback == self._function
 
 
 class Observable:
@@ -17,26 +108,60 @@ class Observable:
     observers directly. Instead, it stores the inform-request on an event
     queue. Some other game-logic (game engine) can then process the events all
     at once whenever required, allowing a smooth game experience.
+
+    The eventPriority determines the priority class of the events on the
+    queue, see EventQueue.
+
+    The subscriptions are kept in a tuple that is replaced (never modified)
+    when the subscriptions change, so observers can be added and removed from
+    any thread while the game loop informs. Observers are referenced weakly,
+    see Subscription; an observer must be kept alive by its owner.
     """
 
+    eventPriority = EventQueue.NORMAL
+
     def __init__(self):
-        self._observers = defaultdict(list)
+        self._subscriptions = ()
 
     def observe(self, observer, callback):
-        self._observers[observer].append(callback)
+        subscription = Subscription(observer, callback, self._prune)
+        self._subscriptions += (subscription,)
+        _observables.add(self)
 
     def deobserve(self, observer, callback):
-        try:
-            self._observers[observer].remove(callback)
-            if len(self._observers[observer]) == 0:
-                self._observers.pop(observer, None)
-        except:
-            pass
+        subscriptions = self._subscriptions
+        for (index, subscription) in enumerate(subscriptions):
+            if subscription.matches(observer, callback):
+                self._subscriptions = \
+                    subscriptions[:index] + subscriptions[index + 1:]
+                return
 
-    def inform(self, state=None):
+    def getSubscriptionCount(self):
+        """Returns the number of subscriptions of live observers."""
+        return sum(1 for subscription in self._subscriptions
+                   if subscription.isAlive())
+
+    def _prune(self, ref):
+        """Called when an observer is garbage collected."""
+        self._subscriptions = tuple(subscription
+                                    for subscription in self._subscriptions
+                                    if subscription.isAlive())
+
+    def inform(self, state=None, timestamp=None, origin=None):
         """By calling this method, all observers will be informed that there
         has been a change in this observable. This event will be processed
-        next tick."""
-        for observer in self._observers:
-            for callback in self._observers[observer]:
-                observerEvents.append((callback, self, state))
+        next tick.
+
+        The timestamp (engine clock, ns) is the moment the change happened. By
+        default this is the timestamp of the event that is being processed
+        (the cause of this change), or else the current time. Likewise the
+        origin (the input device that caused the change) is by default the
+        origin of the event that is being processed."""
+        queue = _eventqueue
+        if timestamp is None:
+            timestamp = eventTime()
+        if origin is None:
+            origin = queue.origin
+        priority = self.eventPriority
+        for subscription in self._subscriptions:
+            queue.push(subscription, self, state, priority, timestamp, origin)
@@ -0,0 +1,89 @@
+import itertools
+import threading
+from collections import deque
+
+
+class EventQueue():
+
+    """
+    Queue that holds all observer events that need to be processed during the
+    next game frame. Owned by the game engine.
+
+    Ordering rule: events are processed by priority class first (INPUT before
+    NORMAL before TIMER), and within a priority class in the order they were
+    pushed (sequence number). Every event gets a unique, increasing sequence
+    number.
+
+    Events that are pushed while the queue is being drained are processed in
+    the same drain (thus in the same frame), following the same rule: a new
+    input event is handled before any remaining normal or timer event, a new
+    normal event is handled after all normal events that were already queued.
+
+    Every event carries a timestamp (engine clock, ns): the moment the event
+    happened, e.g. when an input change was captured. Events can also carry
+    their origin: the input device whose change (indirectly) caused the
+    event. While an event is processed, its timestamp and origin are
+    available as the timestamp and origin attributes.
+
+    Pushing is safe from any thread, draining must only be done by the game
+    loop.
+    """
+
+    INPUT = 0   # Hardware input changes (switches, buttons)
+    NORMAL = 1  # Everything else (outputs, game devices)
+    TIMER = 2   # Timeouts, processed after the frame's inputs
+    PRIORITIES = (INPUT, NORMAL, TIMER)
+
+    def __init__(self):
+        self._queues = tuple(deque() for _ in self.PRIORITIES)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+        # Timestamp and origin of the event that is being processed, None
+        # when the queue is not being drained.
+        self.timestamp = None
+        self.origin = None
+
+    def push(self, callback, cause, state=None, priority=NORMAL,
+             timestamp=None, origin=None):
+        """Queue callback(cause, state), returns the sequence number of the
+        event."""
+        with self._lock:
+            seq = next(self._seq)
+            self._queues[priority].append(
+                (seq, callback, cause, state, timestamp, origin))
+        return seq
+
+    def drain(self):
+        """Processes events until the queue is empty, returns the number of
+        processed events."""
+        queues = self._queues
+        processed = 0
+        while True:
+            for queue in queues:
+                if queue:
+                    break
+            else:
+                self.timestamp = None
+                self.origin = None
+                return processed
+
+            (_, callback, cause, state, self.timestamp,
+             self.origin) = queue.popleft()
+            callback(cause, state)
+            processed += 1
+
+    def setOrigin(self, origin, timestamp):
+        """Sets the origin and timestamp of the event that is being processed,
+        for work that is done outside drain() as if it were an event caused
+        by origin (see pinball.hwrules). None and None when done."""
+        self.origin = origin
+        self.timestamp = timestamp
+
+    def clear(self):
+        with self._lock:
+            for queue in self._queues:
+                queue.clear()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues)
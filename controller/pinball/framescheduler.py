@@ -0,0 +1,159 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FrameScheduler():
+
+    """
+    Paces the game loop at a fixed frame rate. After each frame, wait() sleeps
+    until the absolute (monotonic) deadline of the next frame, so the rate
+    does not drift with the time spent in a frame.
+
+    Sleeping is done in two parts: a normal sleep that ends 'spin' seconds
+    before the deadline, followed by a busy wait for the final stretch. The
+    normal sleep is shortened by the average oversleep of previous frames
+    (jitter compensation). With spin=0 no busy waiting is done at all.
+
+    When a frame takes longer than its period (overrun), the overrun policy
+    decides what happens next:
+        SKIP:    the missed frames are dropped, the next frame starts
+                 immediately and has to end at the next period boundary.
+        CATCHUP: the missed frames are executed back to back without sleeping
+                 (at most maxCatchup frames), until the schedule is met again.
+        DEGRADE: the frame rate is lowered step by step (down to minRate).
+                 When the frames fit again, the rate is slowly restored.
+    """
+
+    SKIP = "skip"
+    CATCHUP = "catchup"
+    DEGRADE = "degrade"
+
+    def __init__(self, rate=500, overrun=SKIP, spin=0.0, minRate=None,
+                 maxCatchup=10, clock=time.monotonic_ns, sleep=time.sleep):
+        """Constructor.
+        @param rate Target frame rate (Hz)
+        @param overrun Overrun policy: SKIP, CATCHUP or DEGRADE
+        @param spin Time (s) before the deadline to switch to busy waiting
+        @param minRate Lowest frame rate for the DEGRADE policy
+        @param maxCatchup Max frames to catch up for the CATCHUP policy
+        """
+        if overrun not in (self.SKIP, self.CATCHUP, self.DEGRADE):
+            raise ValueError("Unknown overrun policy: {}".format(overrun))
+
+        self._targetPeriod = int(1e9 / rate)
+        self._maxPeriod = int(1e9 / (minRate or rate / 4))
+        self._period = self._targetPeriod
+        self._policy = overrun
+        self._spin = int(spin * 1e9)
+        self._maxCatchup = maxCatchup
+        self._clock = clock
+        self._sleep = sleep
+
+        self._deadline = None
+        self._oversleep = 0   # Average oversleep (ns) of time.sleep
+        self._headroom = 0    # Consecutive frames that fit (DEGRADE)
+
+        self.reset()
+
+    def reset(self):
+        """Clears the statistics."""
+        self.frames = 0         # Number of frames
+        self.overruns = 0       # Frames that did not finish before deadline
+        self.skipped = 0        # Frames dropped by SKIP (or CATCHUP limit)
+        self.lateFrames = 0     # Frames that started late (> 10% of period)
+        self.maxLateness = 0    # Max start lateness (ns) of a frame
+
+    def start(self):
+        """Sets the deadline of the first frame."""
+        self._deadline = self._clock() + self._period
+
+    def skipTo(self, until):
+        """Moves the deadline of the next frame forward to the first frame
+        deadline at or after until (ns), keeping the frame grid. The frames in
+        between are not executed, e.g. to fast forward idle frames on a
+        simulated clock."""
+        if self._deadline is None:
+            self.start()
+        if until > self._deadline:
+            periods = -(-(until - self._deadline) // self._period)
+            self._deadline += periods * self._period
+
+    def getRate(self):
+        """Returns the current frame rate (Hz)."""
+        return 1e9 / self._period
+
+    def wait(self):
+        """Waits until the start of the next frame."""
+        if self._deadline is None:
+            self.start()
+
+        self.frames += 1
+        now = self._clock()
+        deadline = self._deadline
+
+        if now > deadline:
+            self.overruns += 1
+            self._overrun(now)
+            return
+
+        self._headroom += 1
+        if self._period != self._targetPeriod and self._headroom > 100:
+            # DEGRADE: frames fit again, slowly go back to the target rate
+            self._headroom = 0
+            self._period = max(self._targetPeriod, self._period * 9 // 10)
+
+        # Sleep, compensated for the average oversleep
+        remaining = deadline - now - self._spin - self._oversleep
+        if remaining > 0:
+            self._sleep(remaining / 1e9)
+            now = self._clock()
+            oversleep = now - (deadline - self._spin - self._oversleep)
+            self._oversleep = max(0, (7 * self._oversleep + oversleep) // 8)
+
+        # Busy wait for the final stretch
+        if self._spin:
+            clock = self._clock
+            while now < deadline:
+                now = clock()
+
+        self._late(now - deadline)
+        self._deadline = deadline + self._period
+
+    def _late(self, lateness):
+        if lateness > self.maxLateness:
+            self.maxLateness = lateness
+        if lateness * 10 > self._period:
+            self.lateFrames += 1
+
+    def _overrun(self, now):
+        self._headroom = 0
+        period = self._period
+        missed = (now - self._deadline) // period
+
+        if self._policy == self.CATCHUP and missed < self._maxCatchup:
+            # Start the next frame immediately, keep the schedule
+            self._deadline += period
+            return
+
+        self._late(now - self._deadline)
+
+        if self._policy == self.DEGRADE and period < self._maxPeriod:
+            self._period = min(self._maxPeriod, period * 5 // 4)
+            logger.debug("frame overrun, rate lowered to {:.0f} Hz".format(
+                self.getRate()))
+
+        # Drop the missed frames, continue at the next period boundary
+        self.skipped += missed
+        self._deadline += (missed + 1) * period
+
+    def stats(self):
+        return {
+            "rate": self.getRate(),
+            "frames": self.frames,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "lateFrames": self.lateFrames,
+            "maxLateness": self.maxLateness,
+        }
@@ -1,7 +1,9 @@
 import logging
 
 from pinball.gamedevices.gamedevice import GameDevice
+from pinball.gamedevices.statemachine import StateMachine, ANY, FALLING, RISING
 from pinball.gamedevices.timer import GameTimer
+from pinball.hwrules import HardwareRule, ON, OFF
 
 BLOCK = 0
 UNBLOCK = 0
@@ -11,12 +13,13 @@ logger = logging.getLogger(__name__)
 
 
 class Flipperstate:
-    LOW = "Low"  # 0x00
-    ENERGIZED = "Energized"  # 0x01
-    HOLD = "Hold"  # 0x02
-    EOSHOLD = "EOSHold"  # 0x03
-    BLOCKED = "Blocked"  # 0x04
-    EOS_ERROR = "EOS ERROR"  # 0xFF
+    LOW = 0
+    ENERGIZED = 1
+    HOLD = 2
+    EOSHOLD = 3
+    BLOCKED = 4
+
+    NAMES = ("Low", "Energized", "Hold", "EOSHold", "Blocked")
 
 
 class Flipper(GameDevice):
@@ -32,66 +35,59 @@ class Flipper(GameDevice):
     a special hold state. In this special hold state, the flipper can not
     recover from a ball kick: the flipper is down and can not come up again
     without re-pressing the flipper button.
+
+    The flipper button drives the energize coil by a hardware rule, so the
+    flipper moves in the frame the button press is sampled. The state machine
+    below follows one frame later, and handles EOS and the hold coil.
+
+    The flipper is blocked by flipperEvent(BLOCK, True), and unblocked by
+    flipperEvent(UNBLOCK, False).
     """
 
     def __init__(self, button, eos, power_energized, power_hold):
         GameDevice.__init__(self)
 
-        self._state = Flipperstate.LOW
         self._button = button
         self._eos = eos
         self._power_energized = power_energized
         self._power_hold = power_hold
         self._eostimer = GameTimer(0.02)
-
-        button.observe(self, self.flipperEvent)
-        eos.observe(self, self.flipperEvent)
-        self._eostimer.observe(self, self.flipperEvent)
+        self._rule = HardwareRule(
+            button,
+            rising=[(ON, power_energized)],
+            falling=[(OFF, power_energized), (OFF, power_hold)])
+
+        S = Flipperstate
+        self._machine = StateMachine(
+            S.NAMES,
+            [(S.LOW, button, RISING, S.ENERGIZED),
+             (S.LOW, BLOCK, RISING, S.BLOCKED, self._rule.disable),
+             (S.ENERGIZED, button, FALLING, S.LOW),
+             (S.ENERGIZED, eos, RISING, S.HOLD),
+             (S.ENERGIZED, self._eostimer, RISING, S.EOSHOLD,
+              self._eosTimeout),
+             (S.HOLD, button, FALLING, S.LOW),
+             (S.HOLD, eos, FALLING, S.ENERGIZED),
+             (S.EOSHOLD, button, FALLING, S.LOW),
+             (S.EOSHOLD, eos, RISING, S.HOLD, self._eosLate),
+             (S.BLOCKED, UNBLOCK, ANY, S.LOW, self._rule.enable)],
+            outputs=[(power_energized, (S.ENERGIZED,)),
+                     (power_hold, (S.HOLD, S.EOSHOLD))],
+            timer=(self._eostimer, (S.ENERGIZED,)),
+            initial=S.LOW)
+
+    @property
+    def _state(self):
+        return self._machine.getState()
 
     def flipperEvent(self, cause, deviceState=None):
-        state = self._state
-        oldstate = self._state
-
-        if state == Flipperstate.LOW:
-            if cause == self._button and deviceState:
-                state = Flipperstate.ENERGIZED
-            # elif cause == self._eos and deviceState:
-                # state = Flipperstate.EOS_ERROR
-            elif cause == BLOCK and deviceState:
-                state = Flipperstate.BLOCKED
-
-        elif state == Flipperstate.ENERGIZED:
-            if cause == self._button and not deviceState:
-                state = Flipperstate.LOW
-            elif cause == self._eos and deviceState:
-                state = Flipperstate.HOLD
-            elif cause == self._eostimer:
-                logger.error("eos not detected, assuming eos high")
-                state = Flipperstate.EOSHOLD
-
-        elif state == Flipperstate.HOLD:
-            if cause == self._button and not deviceState:
-                state = Flipperstate.LOW
-            elif cause == self._eos and not deviceState:
-                state = Flipperstate.ENERGIZED
-
-        elif state == Flipperstate.EOSHOLD:
-            if cause == self._button and not deviceState:
-                state = Flipperstate.LOW
-            elif cause == self._eos and deviceState:
-                logger.debug("(finally!) got eos")
-                state = Flipperstate.HOLD
-
-        elif state == Flipperstate.BLOCKED:
-            if cause == UNBLOCK:
-                state = Flipperstate.LOW
-
-        if state != oldstate:
-            self._state = state
-            self._power_energized.set(state == Flipperstate.ENERGIZED)
-            self._power_hold.set(
-                state == Flipperstate.HOLD or state == Flipperstate.EOSHOLD)
-            if state == Flipperstate.ENERGIZED:
-                self._eostimer.restart()
-            else:
-                self._eostimer.cancel()
+        self._machine.event(cause, deviceState)
+
+    def getTransitionCounts(self):
+        return self._machine.getTransitionCounts()
+
+    def _eosTimeout(self):
+        logger.error("eos not detected, assuming eos high")
+
+    def _eosLate(self):
+        logger.debug("(finally!) got eos")
@@ -1,4 +1,7 @@
+from functools import partial
+
 from pinball.gamedevices.gamedevice import GameDevice
+from pinball.gamedevices.statemachine import StateMachine, RISING
 
 
 class Inlane(GameDevice):
@@ -33,42 +36,29 @@ class Inlane(GameDevice):
         self._switch_upper = switch_upper
         self._switch_lower = switch_lower
 
-        self._switch_upper.observe(self, self.detectUpper)
-        self._switch_lower.observe(self, self.detectLower)
-
-        self._state = self.NONE
+        self._machine = StateMachine(
+            ("None", "Lower", "Upper"),
+            [(self.NONE, switch_lower, RISING, self.LOWER,
+              partial(self._triggerEvent, self.EVENT_INLANESTART)),
+             (self.LOWER, switch_lower, RISING, self.NONE,
+              partial(self._triggerEvent, self.EVENT_INLANEFAIL)),
+             (self.UPPER, switch_lower, RISING, self.NONE),
+             (self.NONE, switch_upper, RISING, self.UPPER),
+             (self.LOWER, switch_upper, RISING, self.UPPER,
+              partial(self._triggerEvent, self.EVENT_INLANEPASSED)),
+             (self.UPPER, switch_upper, RISING, self.UPPER,
+              partial(self._triggerEvent, self.EVENT_INLANEBACK))],
+            initial=self.NONE)
 
     def reset(self):
-        self._state = self.NONE
-
-    def detectLower(self, cause, deviceState=None):
-        """Callback for the inlane lower detection switch."""
-        if not deviceState:
-            return
-
-        laststate = self._state
-        self._state = self.LOWER
-
-        if laststate == self.NONE:
-            self._triggerEvent(self.EVENT_INLANESTART)
-        elif laststate == self.UPPER:
-            self.reset()
-        elif laststate == self.LOWER:
-            self._triggerEvent(self.EVENT_INLANEFAIL)
-            self.reset()
-
-    def detectUpper(self, cause, deviceState=None):
-        """Callback for the inlane upper detection switch."""
-        if not deviceState:
-            return
-
-        laststate = self._state
-        self._state = self.UPPER
-
-        if laststate == self.UPPER:
-            self._triggerEvent(self.EVENT_INLANEBACK)
-        elif laststate == self.LOWER:
-            self._triggerEvent(self.EVENT_INLANEPASSED)
+        self._machine.reset(self.NONE)
+
+    def inlaneEvent(self, cause, deviceState=None):
+        """Processes an event of one of the inlane switches."""
+        self._machine.event(cause, deviceState)
+
+    def getTransitionCounts(self):
+        return self._machine.getTransitionCounts()
 
     def registerForInlaneStart(self, observer, callback):
         """Register a callback that is triggered when a ball is fired into
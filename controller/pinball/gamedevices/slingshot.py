@@ -1,36 +1,35 @@
 import logging
-from time import time
 
 from pinball.gamedevices.gamedevice import GameDevice
 from pinball.gamedevices.timer import GameTimer
+from pinball.hwrules import HardwareRule, PULSE
 
 logger = logging.getLogger(__name__)
 
 
 class Slingshot(GameDevice):
 
+    """
+    The coil is pulsed by a hardware rule in the frame the detector is
+    sampled. The rule is disabled for 0.2s after each fire event, so the
+    slingshot can not be fired again too short after another fire event.
+    """
+
     def __init__(self, detector, coil):
         GameDevice.__init__(self)
         self._coil = coil
-        self._coiltimer = GameTimer(0.02)
-        self._lastshot = time()
-
-        detector.observe(self, self.slingshotDetect)
-        self._coiltimer.observe(self, self.deactivate)
-
-    def slingshotDetect(self, cause, deviceState=None):
-        if not deviceState:
-            return
+        self._rule = HardwareRule(detector, rising=[(PULSE, coil, 20)],
+                                  fired=self.slingshotFired)
+        self._cooldown = GameTimer(0.2)
 
-        if time() - self._lastshot < 0.2:
-            logging.info("slingshot fired again too short after another fire event")
-            return
+        self._cooldown.observe(self, self.cooldownEnd)
 
-        self._lastshot = time()
-        self._coil.set(True)
-        self._coiltimer.restart()
-        logging.info("slingshot fire")
+    def slingshotFired(self, deviceState, timestamp):
+        """Called by the rule when it pulsed the coil, for the detector edge
+        captured at timestamp."""
+        self._rule.disable()
+        self._cooldown.restart(timestamp)
+        logger.debug("slingshot fire")
 
-    def deactivate(self, cause, deviceState=None):
-        self._coil.set(False)
-        logging.info("slingshot low")
+    def cooldownEnd(self, cause, deviceState=None):
+        self._rule.enable()
@@ -0,0 +1,130 @@
+from pinball.e_observable import eventTime
+
+"""
+Table driven state machine for game devices.
+
+States are integers (indexes in the list of state names). A transition is
+triggered by an edge of a source (an input device, a timer or any other
+value passed to event()), and is given as a tuple
+
+    (state, source, edge, next state[, action])
+
+with edge RISING, FALLING or ANY. Timers inform with their timeout, so their
+events are RISING edges. The action, if given, is called without arguments
+after the transition.
+
+The outputs are a function of the state: each output is active in a given
+set of states. The transition table is compiled on construction, such that
+an event costs a single table lookup, and a transition only writes the
+outputs whose level differs between the two states. A timer can be bound to
+a set of states: it is (re)started when one of these states is entered, and
+canceled when they are left.
+
+Each transition counts how often it was taken, see getTransitionCounts().
+"""
+
+FALLING = 0
+RISING = 1
+ANY = 2
+
+_START = 1
+_CANCEL = 2
+
+
+class StateMachine():
+
+    def __init__(self, states, transitions, outputs=(), timer=None,
+                 initial=0):
+        """Constructor, observes all sources that are observable.
+        @param states Names of the states
+        @param transitions List of (state, source, edge, next state[, action])
+                           tuples
+        @param outputs List of (output device, active states) tuples
+        @param timer (GameTimer, running states) tuple
+        @param initial Initial state
+        """
+        self._states = list(states)
+        self._state = initial
+        self._timer = timer[0] if timer else None
+        timed = set(timer[1]) if timer else set()
+
+        # Per source a row with an entry per (state, edge), None if there is
+        # no transition
+        self._table = {}
+        self._names = []
+        self._counts = []
+        for transition in transitions:
+            (state, source, edge, next) = transition[:4]
+            action = transition[4] if len(transition) > 4 else None
+
+            writes = tuple(
+                device.activate if next in active else device.deactivate
+                for (device, active) in outputs
+                if (state in active) != (next in active))
+            if next in timed and state not in timed:
+                timeraction = _START
+            elif state in timed and next not in timed:
+                timeraction = _CANCEL
+            else:
+                timeraction = None
+
+            if not writes and timeraction is None:
+                writes = timeraction = None
+            entry = (next, len(self._counts), writes, timeraction, action)
+            row = self._table.get(source)
+            if row is None:
+                row = self._table[source] = [None] * (2 * len(self._states))
+                if hasattr(source, "observe"):
+                    source.observe(self, self.event)
+            for level in ((FALLING, RISING) if edge == ANY else (edge,)):
+                row[2 * state + level] = entry
+
+            if hasattr(source, "getName"):
+                name = source.getName()
+            elif hasattr(source, "observe"):
+                name = type(source).__name__
+            else:
+                name = source
+            self._names.append("{} -> {} ({} {})".format(
+                self._states[state], self._states[next], name,
+                ("falling", "rising", "any")[edge]))
+            self._counts.append(0)
+
+    def event(self, cause, level=None):
+        """Processes an edge of cause, returns True if it caused a
+        transition."""
+        row = self._table.get(cause)
+        if row is None:
+            return False
+        entry = row[2 * self._state + (1 if level else 0)]
+        if entry is None:
+            return False
+
+        (self._state, index, writes, timeraction, action) = entry
+        self._counts[index] += 1
+        if writes is not None:
+            for write in writes:
+                write()
+            if timeraction == _START:
+                # Counted from the moment of the event
+                self._timer.restart(eventTime())
+            elif timeraction == _CANCEL:
+                self._timer.cancel()
+        if action is not None:
+            action()
+        return True
+
+    def getState(self):
+        return self._state
+
+    def getStateName(self):
+        return self._states[self._state]
+
+    def reset(self, state=0):
+        """Sets the state, without writing any outputs or timers."""
+        self._state = state
+
+    def getTransitionCounts(self):
+        """Returns the number of times each transition was taken, per
+        "state -> next state (source edge)" description."""
+        return dict(zip(self._names, self._counts))
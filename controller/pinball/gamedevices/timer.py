@@ -1,7 +1,26 @@
-import threading
-
 from pinball.gamedevices.gamedevice import GameDevice
-from pinball.e_observable import Observable
+from pinball.e_observable import Observable, eventTime
+from pinball.eventqueue import EventQueue
+from pinball.timerqueue import TimerQueue
+
+# Queue on which all game timers are scheduled. The game engine binds its own
+# queue on construction, see bindTimerQueue().
+_timerqueue = TimerQueue()
+
+
+def bindTimerQueue(queue):
+    """Schedules all game timers on the given queue, timers that are already
+    running are moved to the new queue. Returns the previously bound queue."""
+    global _timerqueue
+    old = _timerqueue
+    queue.adopt(old)
+    _timerqueue = queue
+    return old
+
+
+def getTimerQueue():
+    """Returns the queue on which the game timers are scheduled."""
+    return _timerqueue
 
 
 class GameTimer(GameDevice, Observable):
@@ -12,31 +31,49 @@ class GameTimer(GameDevice, Observable):
     all the observers will be notified. The status argument contains the set
     timeout. When a GameTimer is canceled before the timeout occurs, then
     the observers are not notified.
+
+    Timers do not use threads, they are fired by the game engine at the start
+    of the first frame after the timeout. The timeout event carries the
+    moment the timeout expired as its timestamp.
     """
 
+    eventPriority = EventQueue.TIMER
+
     def __init__(self, timeout):
         """Constructor, timeout in seconds."""
         GameDevice.__init__(self)
         Observable.__init__(self)
         self._t = None
         self._timeout = timeout
+        self._lateness = 0
 
-    def restart(self):
+    def restart(self, since=None):
         self.cancel()
-        self.start()
+        self.start(since)
 
     def cancel(self):
         if self._t:
-            self._t.cancel()
+            _timerqueue.cancel(self._t)
             self._t = None
 
-    def start(self):
+    def start(self, since=None):
+        """Starts the timer. The timeout is counted from since (engine clock,
+        ns), by default the time of the event that is being processed."""
+        if since is None:
+            since = eventTime()
         self._enabled = True
-        self._t = threading.Timer(self._timeout, self._handle)
-        self._t.setDaemon(True)
-        self._t.start()
+        self._t = _timerqueue.schedule(self._timeout, self._handle, since)
+
+    def isRunning(self):
+        return self._t is not None and self._t.isPending()
+
+    def getLateness(self):
+        """Returns how late (in ns) the last timeout was fired, compared to
+        the requested timeout."""
+        return self._lateness
 
-    def _handle(self):
+    def _handle(self, lateness):
         """Internal handle, informs all observers on the occurence of a
         timeout."""
-        self.inform(self._timeout)
+        self._lateness = lateness
+        self.inform(self._timeout, self._t.deadline)
@@ -1,22 +1,115 @@
 import logging
 import time
-import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import pinball.clock as clock
 import pinball.e_observable as e_observable
+import pinball.gamedevices.timer as timer
+import pinball.hwrules as hwrules
+import pinball.latency as latency
+import pinball.recorder as recorder
 from pinball.debugger import DebugEngine
+from pinball.debugserver import DebugProcess
+from pinball.eventqueue import EventQueue
+from pinball.framescheduler import FrameScheduler
+from pinball.profiler import FrameProfiler, Histogram
+from pinball.timerqueue import TimerQueue
 
 logger = logging.getLogger(__name__)
 
 class HardwareEngine():
 
-    def __init__(self, hwcontrollers):
+    """
+    Syncs the hardware controllers in two phases: first the inputs of all
+    controllers are sampled, next the outputs of all controllers are
+    committed. A phase ends when all controllers have finished it (frame
+    barrier). In between, the hardware rules triggered by the sampled inputs
+    are executed (see pinball.hwrules), so their outputs are committed in the
+    same frame. Controllers on the same bus are synced one after another, in
+    their bus order (see HWController.busOrder).
+
+    In concurrent mode the controllers are grouped per bus, and the groups run
+    each phase concurrently on a small worker pool (the game thread takes the
+    first group). Controllers on the same bus are still synced one after
+    another. The duration of a phase is then that of the slowest bus instead
+    of the sum of all busses. Note that input events of different busses are
+    then queued in no particular order.
+    """
+
+    def __init__(self, hwcontrollers, profiler=None, concurrent=False,
+                 rules=None):
+        """Constructor.
+        @param rules RuleQueue of the hardware rules, default the bound queue
+                     (see pinball.hwrules)
+        """
         self.hwcontrollers = hwcontrollers
+        self._rules = hwrules.getRuleQueue() if rules is None else rules
+
+        # Per controller the commit and sample time histograms
+        self._controllers = []
+        for controller in hwcontrollers:
+            if profiler:
+                tcommit = profiler.histogram("commit " + str(controller))
+                tsample = profiler.histogram("sample " + str(controller))
+            else:
+                tcommit = tsample = Histogram()
+            self._controllers.append((controller, tcommit, tsample))
+
+        # Group controllers on their bus, in bus order
+        groups = {}
+        for entry in self._controllers:
+            bus = entry[0].bus
+            groups.setdefault(id(entry) if bus is None else bus, []).append(
+                entry)
+        self._groups = [sorted(group, key=lambda entry: entry[0].busOrder)
+                        for group in groups.values()]
+        self._controllers = [entry for group in self._groups
+                             for entry in group]
+
+        self._pool = None
+        if concurrent and len(self._groups) > 1:
+            self._pool = ThreadPoolExecutor(
+                max_workers=len(self._groups) - 1,
+                thread_name_prefix="hwsync")
 
     def tick(self):
         """Advance to the next game frame.
         Syncs all input and output devices with the controller states."""
-        for controller in self.hwcontrollers:
-            controller.sync()
+        if self._pool:
+            self._concurrent(self._sample)
+            self._rules.run()
+            self._concurrent(self._commit)
+        else:
+            self._sample(self._controllers)
+            self._rules.run()
+            self._commit(self._controllers)
+
+    def _concurrent(self, phase):
+        futures = [self._pool.submit(phase, group)
+                   for group in self._groups[1:]]
+        phase(self._groups[0])
+        for future in futures:
+            # Barrier, re-raises the exceptions of the workers
+            future.result()
+
+    @staticmethod
+    def _commit(controllers):
+        clock = time.monotonic_ns
+        tracer = latency.getTracer()
+        for (controller, tcommit, _) in controllers:
+            start = clock()
+            controller.commit()
+            tcommit.add(clock() - start)
+            if tracer.enabled and not controller.tracesCommit:
+                tracer.committed(controller)
+
+    @staticmethod
+    def _sample(controllers):
+        clock = time.monotonic_ns
+        for (controller, _, tsample) in controllers:
+            start = clock()
+            controller.sample()
+            tsample.add(clock() - start)
 
     def getHwDevices(self):
         """Returns a list of all hardware devices registered to the hardware
@@ -29,39 +122,168 @@ class HardwareEngine():
 
 class GameEngine():
 
-    def __init__(self, hwcontrollers, gamelogic):
-        self._fps = FPS()
-        self._hwengine = HardwareEngine(hwcontrollers)
+    def __init__(self, hwcontrollers, gamelogic, rate=500,
+                 overrun=FrameScheduler.SKIP, spin=0.0, concurrentSync=False,
+                 gameclock=None, latencyTracing=False, debugInterval=0.02,
+                 debugger="thread", debugPath="/dev/shm/pinball",
+                 flightRecorder=None):
+        """Constructor.
+        @param rate Target number of game frames per second
+        @param overrun Policy when a frame takes too long, see FrameScheduler
+        @param spin Time (s) to busy wait before each frame deadline
+        @param concurrentSync Sync controllers on different busses
+                              concurrently, see HardwareEngine
+        @param gameclock Engine clock, default the bound clock (see
+                         pinball.clock). A VirtualClock must be bound before
+                         the game devices are created.
+        @param latencyTracing Trace the input to output latencies, see
+                              pinball.latency
+        @param debugInterval Time (s) between debugger device updates, 0 for
+                             every frame
+        @param debugger "thread" to serve the debugger from the game process,
+                        "process" to serve it from a separate process fed by
+                        a shared state file (see pinball.debugserver), or
+                        None for no debugger
+        @param debugPath Shared state file of the "process" debugger
+        @param flightRecorder Ring file of the flight recorder, None to not
+                              record (see pinball.recorder)
+        """
+        self._clock = gameclock or clock.getClock()
+        clock.bindClock(self._clock)
+        self._events = EventQueue()
+        e_observable.bindEventQueue(self._events)
+        self._timers = TimerQueue(self._clock.now)
+        timer.bindTimerQueue(self._timers)
+        self._latency = latency.LatencyTracer(latencyTracing)
+        latency.bindTracer(self._latency)
+        self._rules = hwrules.RuleQueue()
+        hwrules.bindRuleQueue(self._rules)
+
+        self._scheduler = FrameScheduler(rate, overrun, spin,
+                                         clock=self._clock.now,
+                                         sleep=self._clock.sleep)
+        self._fps = FPS(self._timers)
+        self._profiler = FrameProfiler(self._timers)
+        self._hwengine = HardwareEngine(
+            hwcontrollers, self._profiler, concurrentSync, self._rules)
+        self._recorder = recorder.FlightRecorder(flightRecorder)
+        recorder.bindRecorder(self._recorder)
+        self._recorder.start(self._hwengine.getHwDevices())
+
+        # Histograms of the frame phases, see tick()
+        profiler = self._profiler
+        self._tTimers = profiler.histogram("timers")
+        self._tDispatch = profiler.histogram("dispatch")
+        self._tSync = profiler.histogram("sync")
+        self._tFrame = profiler.histogram("frame")
+        self._nQueue = profiler.histogram(FrameProfiler.QUEUEDEPTH, "events")
+        self._nEvents = profiler.histogram(FrameProfiler.EVENTS, "events")
+
         self._gamelogic = gamelogic
-        self._debugger = DebugEngine(self)
+        if debugger == "thread":
+            self._debugger = DebugEngine(self, debugInterval)
+        elif debugger == "process":
+            self._debugger = DebugProcess(self, debugPath,
+                                          interval=debugInterval)
+        elif debugger is None:
+            self._debugger = None
+        else:
+            raise ValueError("unknown debugger {}".format(debugger))
 
     def run(self):
-        self._debugger.start()
-        e_observable.observerEvents.clear()
-        logger.info("game started")
+        if self._debugger is not None:
+            self._debugger.start()
+        self._events.clear()
 
+        scheduler = self._scheduler
+        logger.info("game started at {:.0f} fps".format(scheduler.getRate()))
+        scheduler.start()
         while True:
             self.tick()
-            time.sleep(0.002)
             self._fps.tick()
+            scheduler.wait()
+
+    def runFor(self, duration, fastForward=False):
+        """Runs the game for duration seconds of engine time, without the
+        debugger. On a VirtualClock this runs as fast as possible, e.g. to
+        replay a simulation.
+        @param fastForward Skip the frames in which nothing can happen: no
+                           events, no expired timers and no input changes.
+                           Requires controllers that know their next input
+                           change in advance, see
+                           HWController.getNextInputTime(). The frames that
+                           are executed are the same as without skipping.
+        """
+        self._events.clear()
+
+        scheduler = self._scheduler
+        end = self._clock.now() + int(duration * 1e9)
+        scheduler.start()
+        while self._clock.now() < end:
+            self.tick()
+            self._fps.tick()
+            if fastForward and not self._events:
+                scheduler.skipTo(min(self._nextWakeup(), end))
+            scheduler.wait()
+
+    def _nextWakeup(self):
+        """Returns the first moment (ns) something can happen, see runFor()."""
+        wakeup = self._timers.nextDeadline()
+        if wakeup is None:
+            wakeup = float("inf")
+        for controller in self._hwengine.hwcontrollers:
+            inputs = controller.getNextInputTime()
+            if inputs is None:
+                return 0
+            wakeup = min(wakeup, inputs)
+        return wakeup
+
+    def getClock(self):
+        return self._clock
+
+    def getProfiler(self):
+        """Returns the profiler that keeps the frame timing histograms."""
+        return self._profiler
+
+    def getFlightRecorder(self):
+        return self._recorder
+
+    def getLatencyTracer(self):
+        """Returns the input to output latency tracer."""
+        return self._latency
+
+    def getFrameStats(self):
+        """Returns the frame scheduler statistics (rate, overruns, late
+        frames, etc.)"""
+        return self._scheduler.stats()
 
     def tick(self):
         """Executes the next game logic frame, in the following phases:
-        1: Process all events
-        2: Sync hardware (input and output)
+        1: Fire all expired timers
+        2: Process all events
+        3: Sync hardware (first input, then hardware rules, then output)
+
+        The duration of each phase is kept by the profiler.
         """
+        clock = time.monotonic_ns
+        start = clock()
+        if self._recorder.enabled:
+            self._recorder.frame()
 
-        while e_observable.observerEvents:
-            (event, cause, newstate) = e_observable.observerEvents.pop(0)
-            event(cause, newstate)
+        self._timers.fire()
+        timers = clock()
+
+        self._nQueue.add(len(self._events))
+        self._nEvents.add(self._events.drain())
+        events = clock()
 
-        # TODO: Two pass sync? Write to devices before going to
-        #      sleep, and read from devices after sleep.
-        #
-        #      Not implemented yet:
-        #      When the sleep timer is very low, no one will
-        #      ever notice the difference.
         self._hwengine.tick()
+        end = clock()
+
+        self._tTimers.add(timers - start)
+        self._tDispatch.add(events - timers)
+        self._tSync.add(end - events)
+        self._tFrame.add(end - start)
 
 
 class FPS(e_observable.Observable):
@@ -74,24 +296,19 @@ class FPS(e_observable.Observable):
     engine internal inform mechanism)
     """
 
-    def __init__(self):
+    def __init__(self, timers):
         e_observable.Observable.__init__(self)
         self._frames = 0
-        self._lock = threading.Lock()
+        self._timers = timers
 
-        # Start the FPS thread
-        self._printFPS()
+        # Start the FPS timer
+        self._timers.schedule(1.0, self._printFPS)
 
     def tick(self):
-        with self._lock:
-            self._frames += 1
-
-    def _printFPS(self):
-        t = threading.Timer(1.0, self._printFPS)
-        t.setDaemon(True)
-        t.start()
-        global frames
-        with self._lock:
-            fps = self._frames
-            self._frames = 0
-            self.inform(fps)
+        self._frames += 1
+
+    def _printFPS(self, lateness):
+        self._timers.schedule(1.0 - lateness / 1e9, self._printFPS)
+        fps = self._frames
+        self._frames = 0
+        self.inform(fps)
@@ -0,0 +1,138 @@
+from collections import deque
+
+from pinball.e_observable import getEventQueue
+
+"""
+Hardware rules: switch to coil rules that are executed by the hardware engine
+in the frame the switch edge was sampled, right before the outputs are
+committed. The game logic is still informed of the switch and output changes,
+one frame later as usual.
+
+A rule is a list of actions per edge of its switch, e.g. a flipper:
+
+    HardwareRule(button,
+                 rising=[(PULSE, energized, 30), (ON, hold)],
+                 falling=[(OFF, energized), (OFF, hold)])
+
+Actions:
+    (ON, output)         Activates the output
+    (OFF, output)        Deactivates the output
+    (PULSE, output, ms)  Activates the output for ms milliseconds
+
+A game device that needs to know when its rule fired (not when the switch
+changed, the rule may be disabled) passes a fired callback, see HardwareRule.
+"""
+
+ON = 0
+OFF = 1
+PULSE = 2
+
+
+class RuleQueue():
+
+    """
+    Rules triggered by sampled switch edges, as (rule, state, timestamp)
+    tuples. Filled by the input devices (possibly from the sync worker
+    threads), emptied by run(). Owned by the hardware engine.
+    """
+
+    def __init__(self):
+        self._triggered = deque()
+
+    def push(self, rule, state, timestamp):
+        self._triggered.append((rule, state, timestamp))
+
+    def run(self):
+        """Executes the actions of all triggered rules, in the order the
+        switch edges were sampled. Returns the number of rules executed.
+
+        The actions are executed as if they were events caused by the switch
+        edge: the output changes carry the switch as origin and the moment
+        the edge was captured as timestamp."""
+        triggered = self._triggered
+        if not triggered:
+            return 0
+
+        queue = getEventQueue()
+        count = 0
+        while triggered:
+            (rule, state, timestamp) = triggered.popleft()
+            queue.setOrigin(rule._switch, timestamp)
+            rule.apply(state, timestamp)
+            count += 1
+        queue.setOrigin(None, None)
+        return count
+
+    def __len__(self):
+        return len(self._triggered)
+
+
+# Queue of the triggered rules. The game engine binds the queue of its
+# hardware engine on construction, see bindRuleQueue().
+_rulequeue = RuleQueue()
+
+
+def bindRuleQueue(queue):
+    """Lets all rules queue their triggers on the given queue. Returns the
+    previously bound queue."""
+    global _rulequeue
+    old = _rulequeue
+    _rulequeue = queue
+    return old
+
+
+def getRuleQueue():
+    return _rulequeue
+
+
+class HardwareRule():
+
+    def __init__(self, switch, rising=(), falling=(), fired=None):
+        """Constructor, registers the rule on the switch.
+        @param switch InGameDevice that triggers the rule
+        @param rising Actions executed when the switch is activated
+        @param falling Actions executed when the switch is deactivated
+        @param fired Called as fired(state, timestamp) right after the
+                     actions of an edge were executed
+        """
+        self._switch = switch
+        self._rising = tuple(rising)
+        self._falling = tuple(falling)
+        self._fired = fired
+        self._enabled = True
+        switch.addRule(self)
+
+    def enable(self):
+        self._enabled = True
+
+    def disable(self):
+        """Disables the rule, e.g. to block a flipper when the game is over."""
+        self._enabled = False
+
+    def isEnabled(self):
+        return self._enabled
+
+    def remove(self):
+        self._switch.removeRule(self)
+
+    def trigger(self, state, timestamp):
+        """Called by the switch on a sampled edge, captured at timestamp."""
+        if self._enabled:
+            _rulequeue.push(self, state, timestamp)
+
+    def apply(self, state, timestamp):
+        """Executes the actions of the edge, unless the rule was disabled
+        after it was triggered (e.g. by the fired callback of an earlier
+        edge)."""
+        actions = self._rising if state else self._falling
+        if not self._enabled or not actions:
+            return
+        for action in actions:
+            if action[0] == ON:
+                action[1].activate()
+            elif action[0] == OFF:
+                action[1].deactivate()
+            else:
+                action[1].pulse(action[2])
+        if self._fired is not None:
+            self._fired(state, timestamp)
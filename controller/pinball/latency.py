@@ -0,0 +1,132 @@
+import json
+import logging
+
+from pinball import clock
+from pinball.profiler import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracer():
+
+    """
+    Measures the end-to-end latency from an input change to the resulting
+    output change, per (input, output) pair: from the moment the input
+    change was captured, to the moment the controller of the output
+    committed it to the hardware (for a controller with a background writer,
+    the moment the writer sent it, see take() and complete()).
+
+    The input that caused an output change is traced through the events:
+    every event carries the input device it originates from, so an output
+    change made by an observer callback (or by a hardware rule) is attributed
+    to that input. Output changes made by timers have no input, and are not
+    traced.
+
+    Tracing is disabled by default, a disabled tracer costs one attribute
+    lookup per output change.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._pending = {}     # Per controller [(input, output, timestamp)]
+        self._histograms = {}  # Per (input name, output name)
+        self._budgets = {}     # Per (input name, output name), in ns
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self._pending.clear()
+
+    def setBudget(self, input, output, budget):
+        """Sets the latency budget (s) of an input/output pair, e.g. 0.005
+        for a flipper button and coil. See getViolations()."""
+        self._budgets[(input.getName(), output.getName())] = int(budget * 1e9)
+
+    def output(self, origin, output, timestamp):
+        """Called by an output device that changes state, origin is the input
+        device that caused the change, captured at timestamp (ns)."""
+        controller = output.getController()
+        pending = self._pending.get(controller)
+        if pending is None:
+            pending = self._pending[controller] = []
+        pending.append((origin, output, timestamp))
+
+    def committed(self, controller):
+        """Called by the hardware engine when the controller has committed its
+        outputs. Safe from the sync worker threads, as long as a controller is
+        committed by one thread at a time."""
+        pending = self._pending.get(controller)
+        if not pending:
+            return
+        self.complete(pending)
+        del pending[:]
+
+    def take(self, controller):
+        """Returns the output changes of the controller that are not committed
+        yet, and forgets them. Used by a controller that writes its outputs
+        after commit() returned, see complete()."""
+        pending = self._pending.get(controller)
+        if not pending:
+            return None
+        self._pending[controller] = []
+        return pending
+
+    def complete(self, changes):
+        """Records the latency of the given output changes (see take()),
+        which have been written to the hardware now. Safe from any thread."""
+        now = clock.now()
+        histograms = self._histograms
+        for (origin, output, timestamp) in changes:
+            key = (origin.getName(), output.getName())
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram()
+            histogram.add(now - timestamp)
+
+    def summary(self):
+        """Returns the latency summaries (ns) per "input -> output" pair, with
+        the budget (ns) of the pair if set."""
+        summary = {}
+        for (key, histogram) in list(self._histograms.items()):
+            entry = histogram.summary()
+            if key in self._budgets:
+                entry["budget"] = self._budgets[key]
+            summary["{} -> {}".format(*key)] = entry
+        return summary
+
+    def getViolations(self, percentile=99):
+        """Returns the "input -> output" pairs of which the given latency
+        percentile exceeds the budget."""
+        return sorted("{} -> {}".format(*key)
+                      for (key, budget) in self._budgets.items()
+                      if key in self._histograms and
+                      self._histograms[key].percentile(percentile) > budget)
+
+    def export(self, path):
+        """Writes the summaries to a JSON file."""
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+    def reset(self):
+        self._pending.clear()
+        self._histograms.clear()
+
+
+# The tracer of the game engine. The game engine binds its own tracer on
+# construction, see bindTracer().
+_tracer = LatencyTracer()
+
+
+def bindTracer(tracer):
+    """Lets all output devices report to the given tracer. Returns the
+    previously bound tracer."""
+    global _tracer
+    old = _tracer
+    _tracer = tracer
+    return old
+
+
+def getTracer():
+    return _tracer
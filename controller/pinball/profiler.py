@@ -0,0 +1,113 @@
+from pinball.e_observable import Observable
+
+
+class Histogram():
+
+    """
+    Histogram with fixed, logarithmic buckets: every power of two is split in
+    four buckets, so percentiles are accurate to within 25%. Adding a value
+    is O(1) and does not allocate.
+    """
+
+    SUBBUCKETS = 4
+    BUCKETS = 64 * SUBBUCKETS
+
+    def __init__(self, unit="ns"):
+        self.unit = unit
+        self._buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.max = 0
+
+    def add(self, value):
+        if value < self.SUBBUCKETS:
+            index = max(0, value)
+        else:
+            bits = value.bit_length()
+            index = (bits - 3) * self.SUBBUCKETS + (value >> (bits - 3))
+        self._buckets[index] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Returns an (upper bound) estimate of the p-th percentile, where p
+        is in the range [0, 100]."""
+        if not self.count:
+            return 0
+        needed = self.count * p / 100
+        seen = 0
+        for index, n in enumerate(self._buckets):
+            seen += n
+            if n and seen >= needed:
+                return min(self.max, self._upper(index))
+        return self.max
+
+    def _upper(self, index):
+        if index < self.SUBBUCKETS:
+            return index
+        (octave, sub) = divmod(index, self.SUBBUCKETS)
+        return ((self.SUBBUCKETS + sub + 1) << (octave - 1)) - 1
+
+    def reset(self):
+        buckets = self._buckets
+        for index in range(self.BUCKETS):
+            buckets[index] = 0
+        self.count = 0
+        self.max = 0
+
+    def summary(self):
+        return {
+            "unit": self.unit,
+            "count": self.count,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class FrameProfiler(Observable):
+
+    """
+    Keeps timing histograms of the phases of a game frame (in ns) and of the
+    hardware sync per controller, and histograms of the event queue depth and
+    the number of processed events per frame.
+
+    Every reporting window (default: one second) the summaries of all
+    histograms are informed to the observers, and the histograms are reset.
+    The last report can be queried with getReport().
+    """
+
+    QUEUEDEPTH = "queue depth"  # Events on the queue at the start of a frame
+    EVENTS = "events/frame"     # Events processed per frame
+
+    def __init__(self, timers, window=1.0):
+        Observable.__init__(self)
+        self._histograms = {}
+        self._report = {}
+        self._timers = timers
+        self._window = window
+        self._timers.schedule(window, self._endWindow)
+
+    def histogram(self, name, unit="ns"):
+        """Returns the histogram with the given name, intended to be looked up
+        once and then used every frame."""
+        if name not in self._histograms:
+            self._histograms[name] = Histogram(unit)
+        return self._histograms[name]
+
+    def summary(self):
+        """Returns the summaries of the current (unfinished) window."""
+        return {name: histogram.summary()
+                for (name, histogram) in self._histograms.items()}
+
+    def getReport(self):
+        """Returns the summaries of the last finished window."""
+        return self._report
+
+    def _endWindow(self, lateness):
+        self._timers.schedule(self._window - lateness / 1e9, self._endWindow)
+        self._report = self.summary()
+        for histogram in self._histograms.values():
+            histogram.reset()
+        self.inform(self._report)
+
@@ -0,0 +1,264 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from pinball import clock
+
+logger = logging.getLogger(__name__)
+
+"""
+Flight recorder: records every input and output change, timer fire and frame
+boundary of the game engine as fixed-size binary records in a memory mapped
+ring file. The file survives a crash of the game process (and, up to the last
+flush, a power loss), see read() and the flightrecorder.py tool to decode it.
+
+Layout (little endian):
+
+    Header   see HEADER below
+    Names    per device "I<TAB>name" (input) or "O<TAB>name" (output),
+             terminated by a newline (UTF-8). The device index of a record is
+             the position in this list. Written once.
+    Bitmap   current level per device, bit (index % 8) of byte (index // 8)
+    Ring     ringSize records of (timestamp uint64, index uint16, kind uint8,
+             state uint8, pad), see RECORD. Record n is written at position
+             n % ringSize, head is the number of records written.
+
+Records (timestamp: engine clock, ns):
+
+    INPUT   index: the input, state: the raw (not inverted) level, timestamp:
+            the moment the level was captured
+    OUTPUT  index: the output, state: the level set by the game
+    TIMER   a timer fired, index: its lateness in us (at most 0xFFFF)
+    FRAME   a game frame starts, index: the frame number (modulo 0x10000)
+"""
+
+MAGIC = b"PBFR"
+VERSION = 1
+
+INPUT = 0
+OUTPUT = 1
+TIMER = 2
+FRAME = 3
+
+KINDS = ("INPUT", "OUTPUT", "TIMER", "FRAME")
+
+# Header fields: (name, format)
+_FIELDS = (
+    ("magic", "4s"), ("version", "I"),
+    ("pid", "I"),             # Game process
+    ("devices", "I"), ("namesLength", "I"),
+    ("bitmapOffset", "I"), ("ringOffset", "I"), ("ringSize", "I"),
+    ("start", "Q"),           # Engine clock when the recording started
+    ("wallclock", "q"),       # Wall clock (ns since epoch) minus engine clock
+    ("head", "Q"))
+HEADER = struct.Struct("<" + "".join(f for (_, f) in _FIELDS))
+RECORD = struct.Struct("<QHBB4x")
+
+_HEAD = HEADER.size - struct.calcsize("<Q")
+_U64 = struct.Struct("<Q")
+
+
+class FlightRecorder():
+
+    """
+    Writes the records to the ring file. Every record costs a struct pack into
+    the mapping and a header update: no allocations, no system calls. Records
+    are written under a lock, as the controllers on different busses record
+    their inputs from their own threads (see GameEngine concurrentSync). The
+    mapping is flushed to disk every flushInterval seconds by a background
+    thread.
+
+    Disabled until started, a disabled recorder costs one attribute lookup per
+    event.
+    """
+
+    def __init__(self, path=None, ringSize=65536, flushInterval=1.0):
+        """Constructor.
+        @param path Ring file, None for a disabled recorder
+        @param ringSize Number of records kept
+        @param flushInterval Time (s) between flushes to disk, 0 to leave it
+                             to the kernel
+        """
+        self.enabled = False
+        self._path = path
+        self._ringSize = ringSize
+        self._flushInterval = flushInterval
+        self._mmap = None
+        self._index = {}
+        self._head = 0
+        self._frames = 0
+        self._lock = threading.Lock()
+
+    def getPath(self):
+        return self._path
+
+    def start(self, devices):
+        """Creates the ring file for the given (hardware) devices and starts
+        recording (the game engine starts the recorder when it is
+        constructed). A previous file is kept as <path>.1, so the recording
+        of a crashed game survives the restart."""
+        if self._path is None:
+            return
+        self._index = {device: index for (index, device) in enumerate(devices)}
+        names = "".join(
+            "{}\t{}\n".format("O" if hasattr(device, "activate") else "I",
+                              device.getName())
+            for device in devices).encode()
+        bitmap = HEADER.size + len(names)
+        ring = bitmap + (len(devices) + 7) // 8
+        size = ring + self._ringSize * RECORD.size
+
+        tmp = "{}.{}".format(self._path, os.getpid())
+        with open(tmp, "w+b") as f:
+            f.truncate(size)
+            self._mmap = mmap.mmap(f.fileno(), size)
+        if os.path.exists(self._path):
+            os.replace(self._path, self._path + ".1")
+        os.replace(tmp, self._path)
+        now = clock.now()
+        HEADER.pack_into(
+            self._mmap, 0, MAGIC, VERSION, os.getpid(), len(devices),
+            len(names), bitmap, ring, self._ringSize, now,
+            time.time_ns() - now, 0)
+        self._mmap[HEADER.size:bitmap] = names
+        self._bitmap = bitmap
+        self._ring = ring
+        self._head = 0
+        self.enabled = True
+
+        if self._flushInterval > 0:
+            threading.Thread(target=self._flusher, name="flightrecorder",
+                             daemon=True).start()
+        logger.info("flight recorder: {} records in {}".format(
+            self._ringSize, self._path))
+
+    def input(self, device, level, timestamp):
+        """Records the raw level of an input, captured at timestamp (ns)."""
+        self._record(INPUT, self._index.get(device), level, timestamp)
+
+    def output(self, device, level):
+        self._record(OUTPUT, self._index.get(device), level, clock.now())
+
+    def timer(self, lateness):
+        self._record(TIMER, min(lateness // 1000, 0xFFFF), 0, clock.now())
+
+    def frame(self):
+        self._frames += 1
+        self._record(FRAME, self._frames & 0xFFFF, 0, clock.now())
+
+    def _record(self, kind, index, state, timestamp):
+        if index is None:
+            # Not a device of the game engine
+            return
+        buf = self._mmap
+        with self._lock:
+            if kind <= OUTPUT:
+                (byte, bit) = divmod(index, 8)
+                if state:
+                    buf[self._bitmap + byte] |= 1 << bit
+                else:
+                    buf[self._bitmap + byte] &= ~(1 << bit) & 0xFF
+            RECORD.pack_into(buf, self._ring + (self._head % self._ringSize) *
+                             RECORD.size, timestamp, index, kind,
+                             1 if state else 0)
+            self._head += 1
+            _U64.pack_into(buf, _HEAD, self._head)
+
+    def flush(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def _flusher(self):
+        while True:
+            time.sleep(self._flushInterval)
+            self.flush()
+
+
+class Recording():
+
+    """A decoded ring file, see read()."""
+
+    def __init__(self, header, devices, levels, records):
+        self.pid = header["pid"]
+        self.start = header["start"]
+        self.wallclock = header["wallclock"]
+        self.head = header["head"]      # Total number of records written
+        self.devices = devices          # (name, is input) per device index
+        self.levels = levels            # Last level per device index
+        self.records = records          # (timestamp, index, kind, state)
+
+    def initialLevels(self):
+        """Returns the level per device index right before the first
+        (oldest) record: the level opposite to that of the first change
+        record of the device, or else its last level."""
+        levels = list(self.levels)
+        seen = set()
+        for (_, index, kind, state) in self.records:
+            if kind <= OUTPUT and index not in seen:
+                seen.add(index)
+                levels[index] = 0 if state else 1
+        return levels
+
+    def toTrace(self):
+        """Returns the input changes as a replay trace of (time (ns), level,
+        name) tuples (see pinball.controllers.simulation), timed since the
+        start of the recording. The inputs that were high before the first
+        record are set at time 0, in case the ring wrapped around."""
+        start = self.start
+        trace = [(0, True, name)
+                 for ((name, isInput), level) in zip(self.devices,
+                                                     self.initialLevels())
+                 if isInput and level]
+        trace += [(timestamp - start, state == 1,
+                   self.devices[index][0])
+                  for (timestamp, index, kind, state) in self.records
+                  if kind == INPUT]
+        return trace
+
+
+def read(path):
+    """Decodes a ring file, returns a Recording with the records oldest
+    first."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise ValueError("{} is not a flight recording".format(path))
+    header = dict(zip((name for (name, _) in _FIELDS),
+                      HEADER.unpack_from(data, 0)))
+    if header["magic"] != MAGIC or header["version"] != VERSION:
+        raise ValueError("{} is not a flight recording".format(path))
+
+    names = data[HEADER.size:HEADER.size + header["namesLength"]]
+    devices = [(entry[2:], entry[0] == "I")
+               for entry in names.decode().split("\n")[:-1]]
+    bitmap = header["bitmapOffset"]
+    levels = [(data[bitmap + index // 8] >> (index % 8)) & 1
+              for index in range(len(devices))]
+
+    ring = header["ringOffset"]
+    size = header["ringSize"]
+    head = header["head"]
+    records = [RECORD.unpack_from(data, ring + (n % size) * RECORD.size)
+               for n in range(max(0, head - size), head)]
+    return Recording(header, devices, levels, records)
+
+
+# The recorder of the game engine. The game engine binds its own recorder on
+# construction, see bindRecorder().
+_recorder = FlightRecorder()
+
+
+def bindRecorder(recorder):
+    """Lets all devices and timers record to the given recorder. Returns the
+    previously bound recorder."""
+    global _recorder
+    old = _recorder
+    _recorder = recorder
+    return old
+
+
+def getRecorder():
+    return _recorder
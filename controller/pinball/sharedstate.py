@@ -0,0 +1,243 @@
+import mmap
+import os
+import struct
+
+from pinball.e_observable import eventTime, subscriptionCount
+
+"""
+Shared state: a memory mapped file (by default in /dev/shm) with a snapshot
+of the game state, written by the game process and read by the out of
+process debugger (see pinball.debugserver).
+
+Layout (little endian):
+
+    Header       see HEADER below
+    Names        device names, then histogram "name<TAB>unit" entries, each
+                 terminated by a newline (UTF-8). Written once.
+    Bitmap       device states, bit (index % 8) of byte (index // 8)
+    Histograms   per histogram: count, p50, p99, max (4 x uint64) of the last
+                 profiler window
+    Ring         ringSize records of (timestamp uint64, device uint16,
+                 state uint8, pad), the last device changes. Record n is
+                 written at position n % ringSize, ringHead is the number of
+                 records written.
+
+The histograms are written under a sequence lock: seq is odd while they are
+being written, a reader retries when it saw an odd or changed seq.
+"""
+
+MAGIC = b"PBSS"
+VERSION = 1
+
+# Header fields: (name, format)
+_FIELDS = (
+    ("magic", "4s"), ("version", "I"),
+    ("seq", "I"),             # Sequence lock of the histograms
+    ("pid", "I"),             # Game process
+    ("devices", "I"), ("histograms", "I"), ("ringSize", "I"),
+    ("namesLength", "I"),
+    ("bitmapOffset", "I"), ("histogramOffset", "I"), ("ringOffset", "I"),
+    ("fps", "I"), ("subscriptions", "I"),
+    ("frames", "Q"), ("ringHead", "Q"))
+HEADER = struct.Struct("<" + "".join(f for (_, f) in _FIELDS))
+HISTOGRAM = struct.Struct("<QQQQ")
+RECORD = struct.Struct("<QHBx4x")
+
+# Byte offset per header field
+_OFFSET = {}
+for (_name, _format) in _FIELDS:
+    _OFFSET[_name] = sum(struct.calcsize("<" + f) for (_, f) in
+                         _FIELDS[:_FIELDS.index((_name, _format))])
+_U32 = struct.Struct("<I")
+_U64 = struct.Struct("<Q")
+
+
+class SharedStateWriter():
+
+    """
+    Game process side: observes the devices, the FPS counter and the profiler
+    and writes their state to the shared file. A device change costs a
+    bitmap update and a ring record (no allocations, no encoding), the
+    histograms are written once per profiler window.
+    """
+
+    def __init__(self, gameengine, path="/dev/shm/pinball", ringSize=256):
+        self._gameengine = gameengine
+        self._path = path
+        self._ringSize = ringSize
+        self._mmap = None
+
+    def getPath(self):
+        return self._path
+
+    def start(self):
+        engine = self._gameengine
+        self._devices = engine._hwengine.getHwDevices()
+        self._index = {device: index
+                       for (index, device) in enumerate(self._devices)}
+        self._histograms = sorted(engine._profiler.summary().items())
+
+        names = "".join(
+            [device.getName() + "\n" for device in self._devices] +
+            ["{}\t{}\n".format(name, h["unit"])
+             for (name, h) in self._histograms]).encode()
+        bitmap = HEADER.size + len(names)
+        histograms = bitmap + (len(self._devices) + 7) // 8
+        ring = histograms + len(self._histograms) * HISTOGRAM.size
+        size = ring + self._ringSize * RECORD.size
+
+        # Create a new file and move it in place, so readers of a previous
+        # file keep a valid mapping (and can tell it is stale)
+        tmp = "{}.{}".format(self._path, os.getpid())
+        with open(tmp, "w+b") as f:
+            f.truncate(size)
+            self._mmap = mmap.mmap(f.fileno(), size)
+        os.replace(tmp, self._path)
+        HEADER.pack_into(
+            self._mmap, 0, MAGIC, VERSION, 0, os.getpid(),
+            len(self._devices), len(self._histograms), self._ringSize,
+            len(names), bitmap, histograms, ring, 0, 0, 0, 0)
+        self._mmap[HEADER.size:bitmap] = names
+        self._bitmap = bitmap
+        self._histogramOffset = histograms
+        self._ring = ring
+        self._head = 0
+        self._frames = 0
+
+        for device in self._devices:
+            self._deviceupdate(device, device.isActivated())
+            device.observe(self, self._deviceupdate)
+        engine._fps.observe(self, self._fpsupdate)
+        engine._profiler.observe(self, self._perfupdate)
+        engine._timers.schedule(0, self._frame)
+
+    def _deviceupdate(self, device, state=None):
+        index = self._index[device]
+        (byte, bit) = divmod(index, 8)
+        buf = self._mmap
+        offset = self._bitmap + byte
+        if state:
+            buf[offset] |= 1 << bit
+        else:
+            buf[offset] &= ~(1 << bit) & 0xFF
+        RECORD.pack_into(buf, self._ring + (self._head % self._ringSize) *
+                         RECORD.size, eventTime(), index, 1 if state else 0)
+        self._head += 1
+        _U64.pack_into(buf, _OFFSET["ringHead"], self._head)
+
+    def _frame(self, lateness):
+        self._gameengine._timers.schedule(0, self._frame)
+        self._frames += 1
+        _U64.pack_into(self._mmap, _OFFSET["frames"], self._frames)
+
+    def _fpsupdate(self, fps, count):
+        _U32.pack_into(self._mmap, _OFFSET["fps"], count)
+        _U32.pack_into(self._mmap, _OFFSET["subscriptions"],
+                       subscriptionCount())
+
+    def _perfupdate(self, profiler, report):
+        buf = self._mmap
+        seq = _U32.unpack_from(buf, _OFFSET["seq"])[0]
+        _U32.pack_into(buf, _OFFSET["seq"], (seq + 1) & 0xFFFFFFFF)
+        for (index, (name, _)) in enumerate(self._histograms):
+            h = report.get(name)
+            if h is not None:
+                HISTOGRAM.pack_into(
+                    buf, self._histogramOffset + index * HISTOGRAM.size,
+                    h["count"], h["p50"], h["p99"], h["max"])
+        _U32.pack_into(buf, _OFFSET["seq"], (seq + 2) & 0xFFFFFFFF)
+
+
+class SharedStateReader():
+
+    """
+    Debugger side: reads the shared file. The file may be (re)created by a
+    new game process at any time, see isStale().
+    """
+
+    def __init__(self, path="/dev/shm/pinball"):
+        self._path = path
+        with open(path, "rb") as f:
+            self._inode = os.fstat(f.fileno()).st_ino
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = dict(zip((name for (name, _) in _FIELDS),
+                          HEADER.unpack_from(self._mmap, 0)))
+        if header["magic"] != MAGIC or header["version"] != VERSION:
+            raise ValueError("{} is not a pinball state file".format(path))
+
+        self.pid = header["pid"]
+        self._ndevices = header["devices"]
+        self._bitmap = header["bitmapOffset"]
+        self._histogramOffset = header["histogramOffset"]
+        self._ring = header["ringOffset"]
+        self._ringSize = header["ringSize"]
+
+        names = self._mmap[HEADER.size:HEADER.size + header["namesLength"]]
+        names = names.decode().split("\n")[:-1]
+        self.devices = names[:self._ndevices]
+        self.histograms = [tuple(entry.split("\t"))
+                           for entry in names[self._ndevices:]]
+
+    def isStale(self):
+        """Returns True if the file was replaced (e.g. by a new game process)
+        since it was opened."""
+        try:
+            return os.stat(self._path).st_ino != self._inode
+        except OSError:
+            return True
+
+    def states(self):
+        """Returns the list of device states (0 or 1)."""
+        bitmap = self._mmap[self._bitmap:self._bitmap + (self._ndevices + 7) // 8]
+        return [(bitmap[index // 8] >> (index % 8)) & 1
+                for index in range(self._ndevices)]
+
+    def fps(self):
+        return _U32.unpack_from(self._mmap, _OFFSET["fps"])[0]
+
+    def subscriptions(self):
+        return _U32.unpack_from(self._mmap, _OFFSET["subscriptions"])[0]
+
+    def frames(self):
+        return _U64.unpack_from(self._mmap, _OFFSET["frames"])[0]
+
+    def ringHead(self):
+        return _U64.unpack_from(self._mmap, _OFFSET["ringHead"])[0]
+
+    def events(self, since):
+        """Returns the (timestamp, device, state) records written after the
+        first since records, and the new head. Returns None as records if
+        records were overwritten before they could be read."""
+        head = self.ringHead()
+        if head - since > self._ringSize:
+            return (None, head)
+        records = []
+        for n in range(since, head):
+            records.append(RECORD.unpack_from(
+                self._mmap, self._ring + (n % self._ringSize) * RECORD.size))
+        if self.ringHead() - since > self._ringSize:
+            # Overwritten while reading
+            return (None, self.ringHead())
+        return (records, head)
+
+    def report(self, retries=100):
+        """Returns the summaries of the histograms of the last profiler
+        window, and its sequence number (changes every window). Returns None
+        as summaries if they were being written during all retries (e.g. the
+        game process died while writing them)."""
+        for _ in range(retries):
+            seq = _U32.unpack_from(self._mmap, _OFFSET["seq"])[0]
+            if seq % 2:
+                continue
+            report = {}
+            for (index, (name, unit)) in enumerate(self.histograms):
+                (count, p50, p99, max) = HISTOGRAM.unpack_from(
+                    self._mmap, self._histogramOffset + index * HISTOGRAM.size)
+                report[name] = {"unit": unit, "count": count, "p50": p50,
+                                "p99": p99, "max": max}
+            if _U32.unpack_from(self._mmap, _OFFSET["seq"])[0] == seq:
+                return (report, seq)
+        return (None, seq)
+
+    def close(self):
+        self._mmap.close()
@@ -0,0 +1,145 @@
+import heapq
+import itertools
+
+from pinball import clock as engineclock
+from pinball import recorder
+
+
+class TimerEntry():
+
+    """A single scheduled timeout, as returned by TimerQueue.schedule()."""
+
+    __slots__ = ("deadline", "callback")
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+
+    def isPending(self):
+        return self.callback is not None
+
+
+class TimerQueue():
+
+    """
+    Heap of timeouts, ordered on their monotonic deadline. The queue does not
+    use any threads: expired timers are fired by calling fire() from the game
+    loop.
+
+    Scheduling is O(log n), cancelling is O(1): a canceled entry stays on the
+    heap until it reaches the top, or until the heap is compacted when most of
+    its entries are canceled.
+
+    Expired timers are called with their lateness: the number of nanoseconds
+    between the deadline and the moment the timer was fired.
+    """
+
+    def __init__(self, clock=engineclock.now):
+        """Constructor, clock is a function that returns a monotonic time in
+        nanoseconds (default: the engine clock)."""
+        self._clock = clock
+        self._heap = []
+        self._seq = itertools.count()
+        self._canceled = 0
+        self._firing = False  # Calling the expired timers, see fire()
+
+        self.fired = 0        # Number of fired timers
+        self.lateness = 0     # Lateness (ns) of the last fired timer
+        self.maxLateness = 0  # Max lateness (ns) of all fired timers
+
+    def schedule(self, timeout, callback, since=None):
+        """Schedules callback(lateness) after timeout seconds, counted from
+        since (ns, default now). Returns an entry that can be used to cancel
+        the timer."""
+        if since is None:
+            since = self._clock()
+        entry = TimerEntry(since + int(timeout * 1e9), callback)
+        heapq.heappush(self._heap, (entry.deadline, next(self._seq), entry))
+        return entry
+
+    def cancel(self, entry):
+        if entry.callback is not None:
+            entry.callback = None
+            self._canceled += 1
+            if not self._firing:
+                self._compactIfNeeded()
+
+    def fire(self):
+        """Calls all timers that are expired, returns the number of timers
+        called. Timers that are scheduled by the callbacks are fired during the
+        next call at the earliest."""
+        heap = self._heap
+        if not heap:
+            return 0
+
+        now = self._clock()
+        if heap[0][0] > now:
+            return 0
+
+        flightrecorder = recorder.getRecorder()
+        expired = []
+        while heap and heap[0][0] <= now:
+            (deadline, _, entry) = heapq.heappop(heap)
+            if entry.callback is None:
+                self._canceled -= 1
+            else:
+                expired.append(entry)
+
+        # The heap is not compacted while the callbacks run: an expired timer
+        # that is canceled by another one is counted in _canceled, but is no
+        # longer on the heap.
+        called = 0
+        self._firing = True
+        try:
+            for entry in expired:
+                callback = entry.callback
+                if callback is None:
+                    # Canceled by one of the other expired timers
+                    self._canceled -= 1
+                    continue
+                entry.callback = None
+                lateness = now - entry.deadline
+                self.lateness = lateness
+                if lateness > self.maxLateness:
+                    self.maxLateness = lateness
+                self.fired += 1
+                called += 1
+                if flightrecorder.enabled:
+                    flightrecorder.timer(lateness)
+                callback(lateness)
+        finally:
+            self._firing = False
+        self._compactIfNeeded()
+        return called
+
+    def nextDeadline(self):
+        """Returns the deadline (ns) of the first pending timer, or None."""
+        heap = self._heap
+        while heap and heap[0][2].callback is None:
+            heapq.heappop(heap)
+            self._canceled -= 1
+        return heap[0][0] if heap else None
+
+    def adopt(self, other):
+        """Moves all pending timers of the other queue to this queue, keeping
+        their remaining time."""
+        offset = self._clock() - other._clock()
+        for (_, _, entry) in other._heap:
+            if entry.callback is not None:
+                entry.deadline += offset
+                heapq.heappush(
+                    self._heap, (entry.deadline, next(self._seq), entry))
+        other._heap = []
+        other._canceled = 0
+
+    def _compactIfNeeded(self):
+        if self._canceled > 32 and self._canceled * 2 > len(self._heap):
+            self._compact()
+
+    def _compact(self):
+        self._heap = [x for x in self._heap if x[2].callback is not None]
+        heapq.heapify(self._heap)
+        self._canceled = 0
+
+    def __len__(self):
+        return len(self._heap) - self._canceled
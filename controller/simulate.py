@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""
+Runs the game of pinball.py headless on a simulated clock, replaying an input
+trace (see pinball/controllers/simulation.py for the trace format).
+
+Usage: simulate.py TRACE [-o OUTPUT] [--time SECONDS] [--rate FPS]
+                         [--latency FILE]
+
+The output trace is written to OUTPUT (default stdout). Two runs with the
+same trace give the same output trace, so it can be diffed to check for
+regressions (tests/test_simulation.py does so for the traces in
+tests/traces). All hardware of pinball.py is replaced by a single
+SimulationController, with the same device names.
+"""
+import argparse
+import logging
+import sys
+import time
+
+import pinball.clock as clock
+
+from pinball.gameengine import GameEngine
+from pinball.controllers.simulation import SimulationController, formatTrace
+from pinball.gamedevices.flipper import Flipper
+from pinball.gamedevices.slingshot import Slingshot
+from pinball.gamedevices.led import Led
+from pinball.gamedevices.inlane import Inlane
+
+from gamelogic import MyGame
+
+
+def buildGame(sim):
+    """Instantiates the devices and game logic of pinball.py on the
+    simulation controller."""
+    flipper_L_POWER_ENERGIZED = sim.getOut("L Flipper coil (high)")
+    flipper_L_POWER_HOLD = sim.getOut("L Flipper coil (hold)")
+    flipper_L_EOS = sim.getIn("L Flipper EOS")
+    flipper_R_POWER_ENERGIZED = sim.getOut("R Flipper coil (high)")
+    flipper_R_POWER_HOLD = sim.getOut("R Flipper coil (hold)")
+    flipper_R_EOS = sim.getIn("R Flipper EOS")
+    flipper_L_BUTTON = sim.getIn("L Flipper button")
+    flipper_R_BUTTON = sim.getIn("R Flipper button")
+
+    slingshot_left_detect = sim.getIn("L Slingshot detect")
+    slingshot_left_coil = sim.getOut("L Slingshot kicker")
+    slingshot_right_detect = sim.getIn("R Slingshot detect")
+    slingshot_right_coil = sim.getOut("R Slingshot kicker")
+
+    inlane_detect_upper = sim.getIn("Switch inlane Upper", inv=True)
+    inlane_detect_lower = sim.getIn("Switch inlane Lower", inv=True)
+
+    led_1 = Led(sim.getOut("Led Blue"))
+    led_2 = Led(sim.getOut("Led Green"))
+    led_3 = Led(sim.getOut("Led Red"))
+
+    flipperL = Flipper(flipper_L_BUTTON, flipper_L_EOS,
+                       flipper_L_POWER_ENERGIZED, flipper_L_POWER_HOLD)
+    flipperR = Flipper(flipper_R_BUTTON, flipper_R_EOS,
+                       flipper_R_POWER_ENERGIZED, flipper_R_POWER_HOLD)
+
+    slingshotL = Slingshot(slingshot_left_detect, slingshot_left_coil)
+    slingshotR = Slingshot(slingshot_right_detect, slingshot_right_coil)
+
+    inlane = Inlane(inlane_detect_upper, inlane_detect_lower)
+
+    return MyGame(flipperL, flipperR, slingshotL, slingshotR, inlane, led_1,
+                  led_2, led_3)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("trace", help="input trace")
+    parser.add_argument("-o", "--output", help="output trace file")
+    parser.add_argument("--time", type=float,
+                        help="simulated seconds, default until 1s after the "
+                             "last input")
+    parser.add_argument("--rate", type=int, default=500, help="frame rate")
+    parser.add_argument("--latency",
+                        help="trace the input to output latencies, and "
+                             "write their summaries (JSON) to this file")
+    args = parser.parse_args(argv)
+
+    # The clock must be bound before the game devices are created
+    clock.bindClock(clock.VirtualClock())
+
+    sim = SimulationController.fromFile(args.trace)
+    game = buildGame(sim)
+    ge = GameEngine([sim], game, rate=args.rate,
+                    latencyTracing=args.latency is not None)
+
+    duration = args.time
+    if duration is None:
+        duration = sim.getLastInputTime() / 1e9 + 1.0
+
+    start = time.perf_counter()
+    ge.runFor(duration, fastForward=True)
+    elapsed = time.perf_counter() - start
+
+    lines = "\n".join(formatTrace(sim.output)) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(lines)
+    else:
+        sys.stdout.write(lines)
+    if args.latency:
+        ge.getLatencyTracer().export(args.latency)
+
+    sys.stderr.write("simulated {:.1f}s in {:.3f}s ({:.0f}x real time)\n".format(
+        duration, elapsed, duration / max(elapsed, 1e-9)))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    main(sys.argv[1:])
@@ -0,0 +1,113 @@
+import sys
+import types
+
+"""
+Stubs of the hardware modules (smbus, serial and RPi.GPIO), so the hardware
+controllers can be tested and benchmarked without hardware. install() must
+be called before the controllers are imported. The stubs do (almost) no
+work, so the benchmarks measure the controller code only.
+"""
+
+
+class SMBus():
+
+    """smbus.SMBus, keeps the register values per (address, register)."""
+
+    def __init__(self, busnr):
+        self.registers = {}
+
+    def write_byte_data(self, address, register, value):
+        self.registers[(address, register)] = value
+
+    def read_byte_data(self, address, register):
+        return self.registers.get((address, register), 0)
+
+    def write_i2c_block_data(self, address, register, values):
+        for (i, value) in enumerate(values):
+            self.registers[(address, register + i)] = value
+
+    def read_i2c_block_data(self, address, register, length):
+        registers = self.registers
+        return [registers.get((address, register + i), 0)
+                for i in range(length)]
+
+
+class Serial():
+
+    """serial.Serial, counts the written bytes. Only receives the reply to a
+    PowerDriver16 handshake."""
+
+    def __init__(self, port=None, baudrate=9600, timeout=None):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.written = 0
+        self.in_waiting = 0
+        self._reply = b""
+
+    def write(self, data):
+        self.written += len(data)
+        if data.startswith(b"\r\nMY MAGIC PINBALL "):
+            # "OK <baudrate> <boards>"
+            self._reply = b"OK " + data[19:].strip() + b"\r\n"
+        return len(data)
+
+    def read(self, size=1):
+        return b""
+
+    def readline(self):
+        (reply, self._reply) = (self._reply, b"")
+        return reply
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        pass
+
+
+class GPIO(types.ModuleType):
+
+    """RPi.GPIO, the input levels per pin can be set in levels."""
+
+    BCM = 11
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    PUD_DOWN = 21
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        types.ModuleType.__init__(self, "RPi.GPIO")
+        self.levels = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None):
+        self.levels.setdefault(pin, 0)
+
+    def input(self, pin):
+        return self.levels.get(pin, 0)
+
+    def add_event_detect(self, pin, edge, callback=None):
+        pass
+
+
+def install():
+    """Installs the stubs as the smbus, serial and RPi.GPIO modules."""
+    smbus = types.ModuleType("smbus")
+    smbus.SMBus = SMBus
+    serial = types.ModuleType("serial")
+    serial.Serial = Serial
+    gpio = GPIO()
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = gpio
+
+    sys.modules["smbus"] = smbus
+    sys.modules["serial"] = serial
+    sys.modules["RPi"] = rpi
+    sys.modules["RPi.GPIO"] = gpio
+    return gpio
@@ -0,0 +1,72 @@
+import unittest
+
+from tests import stubs
+stubs.install()
+
+from pinball.controllers import raspberrypi  # noqa: E402
+from pinball.e_observable import bindEventQueue  # noqa: E402
+from pinball.eventqueue import EventQueue  # noqa: E402
+
+GPIO = raspberrypi.GPIO
+PIN = 17
+
+
+class EdgeDetectTest(unittest.TestCase):
+
+    """Edges reported by the GPIO callback of an edge detected pin."""
+
+    def setUp(self):
+        self.queue = EventQueue()
+        self.oldQueue = bindEventQueue(self.queue)
+        GPIO.levels[PIN] = 0
+        self.controller = raspberrypi.RaspberryPi(edgeDetect=True)
+        self.device = self.controller.getIn("switch", PIN)
+        self.controller._edges.clear()
+
+    def tearDown(self):
+        bindEventQueue(self.oldQueue)
+
+    def edge(self, level):
+        """Calls the GPIO callback, with the pin at level."""
+        GPIO.levels[PIN] = level
+        self.controller._edge(PIN)
+
+    def levels(self):
+        levels = [level for (_, level, _) in self.controller._edges]
+        self.controller._edges.clear()
+        return [1 if level else 0 for level in levels]
+
+    def testEdges(self):
+        self.edge(1)
+        self.edge(0)
+        self.assertEqual(self.levels(), [1, 0])
+
+    def testShortPulse(self):
+        # Both callbacks run after the pin returned to low
+        self.edge(0)
+        self.edge(0)
+        self.assertEqual(self.levels(), [1, 0])
+        self.edge(1)
+        self.assertEqual(self.levels(), [1])
+
+    def testShortPulseThenPress(self):
+        # The callback of the falling edge runs after the next rising edge
+        self.edge(0)
+        self.edge(1)
+        self.edge(1)
+        self.assertEqual(self.levels(), [1, 0, 1])
+        self.edge(0)
+        self.assertEqual(self.levels(), [0])
+
+    def testSample(self):
+        informed = []
+        self.device.observe(self, lambda cause, state: informed.append(state))
+        self.edge(0)
+        self.edge(0)
+        self.controller.sample()
+        self.queue.drain()
+        self.assertEqual(informed, [True, False])
+
+
+if __name__ == "__main__":
+    unittest.main()
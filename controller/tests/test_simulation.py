@@ -0,0 +1,49 @@
+import difflib
+import os
+import tempfile
+import unittest
+
+import pinball.clock as clock
+
+import simulate
+
+TRACES = os.path.join(os.path.dirname(__file__), "traces")
+
+
+class SimulationTest(unittest.TestCase):
+
+    """Replays the input traces in tests/traces with simulate.py, and
+    compares the output traces with the expected ones."""
+
+    def setUp(self):
+        self.oldClock = clock.getClock()
+
+    def tearDown(self):
+        clock.bindClock(self.oldClock)
+
+    def replay(self, name):
+        """Replays traces/<name>.txt, returns the diff of the output trace
+        with traces/<name>.expected.txt."""
+        with open(os.path.join(TRACES, name + ".expected.txt")) as f:
+            expected = f.readlines()
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, name + ".txt")
+            simulate.main([os.path.join(TRACES, name + ".txt"),
+                           "-o", output])
+            with open(output) as f:
+                actual = f.readlines()
+        return "".join(difflib.unified_diff(
+            expected, actual, name + ".expected.txt", name + ".txt"))
+
+    def testBasic(self):
+        # The inlane has no outputs, it is checked on the game logic events
+        with self.assertLogs("gamelogic", "INFO") as logs:
+            diff = self.replay("basic")
+        self.assertEqual(diff, "")
+        self.assertEqual([record.getMessage().strip()
+                          for record in logs.records],
+                         ["GAME: BALL LAUNCH (JEAH!)", "GAME: BALL IN GAME"])
+
+
+if __name__ == "__main__":
+    unittest.main()
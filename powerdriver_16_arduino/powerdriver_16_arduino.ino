@@ -3,13 +3,46 @@
 #define pinMOSI 11
 #define PDB_COMMAND_WRITE 1
 
+/*
+ * Serial protocol, see pinball/controllers/powerdriver16.py:
+ *
+ *   Handshake: "MY MAGIC PINBALL <baudrate> <boards>\r\n"
+ *              -> "OK <baudrate> <boards>\r\n"
+ *   Packets:   SYNC LEN SEQ CMD PAYLOAD[LEN] CHK
+ *
+ * Up to MAX_BOARDS boards are chained on the SPI bus, addressed by their
+ * board number. A bank is only transferred when its output value changed
+ * (and every REFRESH_MS, to recover a board that missed a transfer).
+ *
+ * SoftwareSerial can not receive while it transmits, so the ACKs are
+ * batched: a single ACK for the last packet is sent once the line has been
+ * idle for ACK_IDLE_US, it acknowledges all packets up to that one.
+ *
+ * A packet of which no byte was received for PACKET_TIMEOUT_US is dropped
+ * (counted as a checksum error). Line noise, e.g. a handshake at the wrong
+ * baudrate, may contain a SYNC byte; the parser then returns to WAIT_SYNC
+ * before the host retries the handshake, so the handshake line is not taken
+ * for packet bytes.
+ */
+#define SYNC 0xA5
+#define CMD_WRITE 0x01
+#define CMD_PULSE 0x02
+#define CMD_ACK 0x81
+#define MAX_PAYLOAD 60
+#define MAGIC "MY MAGIC PINBALL"
+#define HANDSHAKE_BAUDRATE 9600
+#define MAX_BOARDS 8
+#define REFRESH_MS 100
+#define ACK_IDLE_US 500
+#define PACKET_TIMEOUT_US 20000
+
 SoftwareSerial softSerial(5, 6); // RX, TX
 
 int c = 0;
 
 void setup() {
   Serial.begin(9600);
-  softSerial.begin(9600);
+  softSerial.begin(HANDSHAKE_BAUDRATE);
 
   SPI.begin();
   SPI.setBitOrder(MSBFIRST);
@@ -40,36 +73,257 @@ void sendPDBCommand(byte addr, byte command, byte bankAddr, byte data)
   interrupts();
 }
 
-byte* banks = (byte*) calloc(2, sizeof(byte));
+byte boards = 1;
 
-void loop() {
+/* Bank values per board, as written by the host */
+byte banks[MAX_BOARDS][2];
 
-  /* Check for new commands */
-  if (softSerial.available() > 2) {
-    byte board = softSerial.read();
-    byte bank = softSerial.read();
-    byte value = softSerial.read();
-    Serial.print("< ");
-    Serial.print(board, HEX);
-    Serial.print(" ");
-    Serial.print(bank, HEX);
-    Serial.print(" ");
-    Serial.println(value, HEX);
+/* Pulsing pins per bank, and the time (low 16 bits of millis) each pulse
+ * ends; pulses are at most 255ms */
+byte pulsing[MAX_BOARDS][2];
+unsigned int pulseEnd[MAX_BOARDS][2][8];
+
+/* Output value last transferred per bank, the number of transfers per
+ * board (reported in the ACKs) and the time of the last refresh */
+byte sent[MAX_BOARDS][2];
+byte transfers[MAX_BOARDS];
+unsigned long lastRefresh = 0;
+
+/* Packet parser state */
+#define WAIT_SYNC 0
+#define READ_LEN 1
+#define READ_BODY 2
+
+byte state = WAIT_SYNC;
+byte packet[MAX_PAYLOAD + 3];  // SEQ CMD PAYLOAD CHK
+byte len = 0;
+byte pos = 0;
+byte expectedSeq = 0;
+byte checksumErrors = 0;
+byte dropped = 0;
+bool synced = false;
+
+/* Sequence number of the last packet, if it is not acknowledged yet, and the
+ * time the last byte was received */
+bool ackPending = false;
+byte ackSeq = 0;
+unsigned long lastByte = 0;
+
+/* Text line buffer for the handshake (outside packets) */
+char line[32];
+byte linePos = 0;
+
+void sendPacket(byte seq, byte cmd, byte* payload, byte payloadLen) {
+  byte sum = payloadLen + seq + cmd;
+  softSerial.write(SYNC);
+  softSerial.write(payloadLen);
+  softSerial.write(seq);
+  softSerial.write(cmd);
+  for (byte i = 0; i < payloadLen; i++) {
+    softSerial.write(payload[i]);
+    sum += payload[i];
+  }
+  softSerial.write((byte) ~sum);
+}
+
+void handleLine() {
+  line[linePos] = 0;
+  linePos = 0;
+  if (strncmp(line, MAGIC, strlen(MAGIC)) != 0) {
+    return;
+  }
+
+  char* end;
+  long baudrate = strtol(line + strlen(MAGIC), &end, 10);
+  if (baudrate <= 0) {
+    baudrate = HANDSHAKE_BAUDRATE;
+  }
+  long count = strtol(end, NULL, 10);
+  boards = (count >= 1 && count <= MAX_BOARDS) ? count : 1;
+
+  softSerial.print("OK ");
+  softSerial.print(baudrate);
+  softSerial.print(" ");
+  softSerial.print(boards);
+  softSerial.print("\r\n");
+  softSerial.flush();
+  softSerial.end();
+  softSerial.begin(baudrate);
+  synced = false;
+  ackPending = false;
+
+  Serial.print("Handshake, baudrate ");
+  Serial.print(baudrate);
+  Serial.print(", boards ");
+  Serial.println(boards);
+
+  /* Transfer all banks of all boards on the next loop */
+  lastRefresh = millis() - REFRESH_MS;
+}
+
+void handlePacket() {
+  byte seq = packet[0];
+  byte cmd = packet[1];
+  byte sum = len;
+  for (byte i = 0; i < len + 2; i++) {
+    sum += packet[i];
+  }
+  if ((byte) (sum + packet[len + 2]) != 0xFF) {
+    checksumErrors++;
+    return;
+  }
+
+  if (synced) {
+    dropped += (byte) (seq - expectedSeq);
+  }
+  synced = true;
+  expectedSeq = seq + 1;
+
+  if (cmd == CMD_WRITE) {
+    for (byte i = 0; i + 3 <= len; i += 3) {
+      byte board = packet[2 + i];
+      byte bank = packet[2 + i + 1];
+      byte value = packet[2 + i + 2];
+
+      if(board >= boards) {
+        Serial.print("ERROR, board >= boards");
+      } else if(bank > 1) {
+        Serial.print("ERROR, bank > 1");
+      } else {
+        banks[board][bank] = value;
+      }
+    }
     c++;
     digitalWrite(13, c%2);
+  } else if (cmd == CMD_PULSE) {
+    unsigned int now = millis();
+    for (byte i = 0; i + 4 <= len; i += 4) {
+      byte board = packet[2 + i];
+      byte bank = packet[2 + i + 1];
+      byte mask = packet[2 + i + 2];
+      byte ms = packet[2 + i + 3];
 
-    /* Multiple boards are not yet supported */
-    if(board != 0) {
-      Serial.print("ERROR, board != 0");
-    } else if(bank > 1) {
-      Serial.print("ERROR, bank > 1");
-    } else {
-      banks[bank] = value;
+      if(board >= boards) {
+        Serial.print("ERROR, board >= boards");
+      } else if(bank > 1) {
+        Serial.print("ERROR, bank > 1");
+      } else if (ms == 0) {
+        /* Cancel, end the pulses right away */
+        pulsing[board][bank] &= ~mask;
+      } else {
+        for (byte pin = 0; pin < 8; pin++) {
+          if (mask & (1 << pin)) {
+            pulseEnd[board][bank][pin] = now + ms;
+          }
+        }
+        pulsing[board][bank] |= mask;
+      }
     }
   }
 
-  /* Send commands to powerdriver */
-  sendPDBCommand(0, PDB_COMMAND_WRITE, 0, banks[0]);  // Write data to bank 0
-  sendPDBCommand(0, PDB_COMMAND_WRITE, 1, banks[1]); // Write inverted data to bank 1
+  /* Acknowledged when the line is idle, see sendAck() */
+  ackPending = true;
+  ackSeq = seq;
+}
+
+void sendAck() {
+  byte ack[2 + MAX_BOARDS];
+  ack[0] = checksumErrors;
+  ack[1] = dropped;
+  for (byte board = 0; board < boards; board++) {
+    ack[2 + board] = transfers[board];
+  }
+  sendPacket(ackSeq, CMD_ACK, ack, 2 + boards);
+  ackPending = false;
+}
+
+void handleByte(byte b) {
+  switch (state) {
+    case WAIT_SYNC:
+      if (b == SYNC) {
+        state = READ_LEN;
+      } else if (b == '\n') {
+        handleLine();
+      } else if (b != '\r') {
+        if (linePos == sizeof(line) - 1) {
+          linePos = 0;  // Too long, not a handshake
+        }
+        line[linePos++] = b;
+      }
+      break;
+
+    case READ_LEN:
+      if (b > MAX_PAYLOAD) {
+        checksumErrors++;
+        state = WAIT_SYNC;
+      } else {
+        len = b;
+        pos = 0;
+        state = READ_BODY;
+      }
+      break;
+
+    case READ_BODY:
+      packet[pos++] = b;
+      if (pos == len + 3) {
+        state = WAIT_SYNC;
+        handlePacket();
+      }
+      break;
+  }
+}
+
+void loop() {
 
+  /* Check for new commands */
+  while (softSerial.available() > 0) {
+    byte b = softSerial.read();
+    unsigned long received = micros();
+    if (state != WAIT_SYNC && received - lastByte >= PACKET_TIMEOUT_US) {
+      /* Stalled packet, start over */
+      checksumErrors++;
+      state = WAIT_SYNC;
+    }
+    handleByte(b);
+    lastByte = received;
+  }
+
+  /* End expired pulses */
+  unsigned int now = millis();
+  for (byte board = 0; board < boards; board++) {
+    for (byte bank = 0; bank < 2; bank++) {
+      if (!pulsing[board][bank]) {
+        continue;
+      }
+      for (byte pin = 0; pin < 8; pin++) {
+        if ((pulsing[board][bank] & (1 << pin)) &&
+            (int) (now - pulseEnd[board][bank][pin]) >= 0) {
+          pulsing[board][bank] &= ~(1 << pin);
+        }
+      }
+    }
+  }
+
+  /* Send the changed banks of all boards to the powerdrivers, or all banks
+   * when it is time to refresh */
+  bool refresh = millis() - lastRefresh >= REFRESH_MS;
+  if (refresh) {
+    lastRefresh = millis();
+  }
+  for (byte board = 0; board < boards; board++) {
+    for (byte bank = 0; bank < 2; bank++) {
+      byte value = banks[board][bank] | pulsing[board][bank];
+      if (refresh || value != sent[board][bank]) {
+        sendPDBCommand(board, PDB_COMMAND_WRITE, bank, value);
+        sent[board][bank] = value;
+        transfers[board]++;
+      }
+    }
+  }
+
+  /* Acknowledge the last packet once the host stopped sending */
+  if (ackPending && state == WAIT_SYNC && softSerial.available() == 0 &&
+      micros() - lastByte >= ACK_IDLE_US) {
+    sendAck();
+  }
 }